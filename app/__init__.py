@@ -3,6 +3,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate, upgrade
 from flask_apscheduler import APScheduler
 from .config import Config
+from datetime import date, timedelta
 import logging
 
 db = SQLAlchemy()
@@ -17,6 +18,22 @@ def create_app(config_class=Config):
     migrate.init_app(app, db)
     scheduler.init_app(app)
 
+    from . import rollup  # Registers the session hook that keeps the daily entry counts up to date
+    from .cache import VersionedCache
+    app.extensions['entry_data_cache'] = VersionedCache(app.config['ENTRY_DATA_CACHE_SIZE'])
+    app.extensions['timeline_cache'] = VersionedCache(app.config['TIMELINE_CACHE_SIZE'])
+    app.extensions['giphy_search_cache'] = VersionedCache(app.config['GIPHY_SEARCH_CACHE_SIZE'], max_age=app.config['GIPHY_SEARCH_CACHE_TTL'])
+    app.extensions['grafana_cache'] = VersionedCache(app.config['GRAFANA_CACHE_SIZE'])
+
+    from .assets import init_static_assets
+    init_static_assets(app)
+
+    from .compression import init_compression
+    init_compression(app)
+
+    from .images import init_image_processing
+    init_image_processing(app)
+
     from .routes import init_app as init_routes
     init_routes(app, scheduler)
         
@@ -35,10 +52,17 @@ def create_app(config_class=Config):
     with app.app_context():
 
         if not app.config['TESTING']:
-            from .helpers import create_upload_folder
+            from .helpers import create_upload_folder, prewarm_date_formats
             create_upload_folder(app.config['UPLOAD_FOLDER'])
+            prewarm_date_formats(date.today() - timedelta(days=app.config['DATE_FORMAT_PREWARM_DAYS']),
+                                 2 * app.config['DATE_FORMAT_PREWARM_DAYS'] + 1,
+                                 app.config['TIMELINE_LOCALE'], app.config['TIMELINE_DATE_FORMAT'])
             scheduler.start()
         
         upgrade() # Apply any pending migrations
+
+        if not app.config['TESTING']:
+            from .images import resume_image_ingestion
+            resume_image_ingestion()
     
     return app
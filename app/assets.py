@@ -0,0 +1,48 @@
+import os
+from hashlib import sha1
+from flask import request
+
+ASSET_HASH_LENGTH = 12  # Hex digits of the content hash appended to static URLs
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60  # One year, in seconds
+PRECOMPRESSED_EXTENSIONS = ('.gz', '.br')
+
+def build_asset_manifest(static_folder):
+    """Maps the path of every file below static_folder, relative and with forward slashes, to a hash of its content."""
+    manifest = {}
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            if name.endswith(PRECOMPRESSED_EXTENSIONS):
+                continue  # Served in place of the original, which carries the hash
+            path = os.path.join(root, name)
+            digest = sha1()
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(65536), b''):
+                    digest.update(chunk)
+            manifest[os.path.relpath(path, static_folder).replace(os.sep, '/')] = digest.hexdigest()[:ASSET_HASH_LENGTH]
+    return manifest
+
+def init_static_assets(app):
+    """Adds content hashes to static URLs and serves hashed URLs as immutable.
+
+    The manifest is computed once at startup, so a changed asset gets a new URL with the next deployment,
+    while browsers never revalidate the assets they already have.
+    """
+    manifest = app.extensions['asset_manifest'] = build_asset_manifest(app.static_folder)
+
+    @app.url_defaults
+    def add_asset_hash(endpoint, values):
+        if endpoint == 'static' and 'v' not in values:
+            asset_hash = manifest.get(values.get('filename'))
+            if asset_hash:
+                values['v'] = asset_hash
+
+    @app.after_request
+    def cache_hashed_assets(response):
+        if request.endpoint == 'static' and response.status_code in (200, 304):
+            asset_hash = manifest.get((request.view_args or {}).get('filename'))
+            if asset_hash and request.args.get('v') == asset_hash:
+                response.cache_control.public = True
+                response.cache_control.max_age = IMMUTABLE_MAX_AGE
+                response.cache_control.immutable = True
+                response.cache_control.no_cache = None
+        return response
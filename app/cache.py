@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from datetime import datetime, date, time, timedelta, timezone
+from functools import wraps
+from hashlib import sha1
+from threading import Event, Lock
+from time import monotonic
+from flask import request, make_response, g, has_app_context
+from werkzeug.http import is_resource_modified
+from app import db
+from .models import DataVersion
+
+DATA_VERSION_ID = 1  # Primary key of the single data version row
+
+def get_data_version(db):
+    """Returns the current data version shared by all workers, 0 if it was never bumped."""
+    return get_data_version_info(db)[0]
+
+def current_data_version(db):
+    """Returns the data version read by conditional_on_data_version for the current request, reading it otherwise."""
+    if has_app_context() and 'data_version' in g:
+        return g.data_version
+    return get_data_version(db)
+
+def get_data_version_info(db):
+    """Returns the current data version and the UTC time of the last change, (0, None) if it was never bumped."""
+    row = db.session.query(DataVersion.version, DataVersion.updated_at).filter_by(id=DATA_VERSION_ID).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+def bump_data_version(db):
+    """Increments the data version within the current transaction.
+
+    Has to be called by every write to entries or categories before its commit, so that
+    all workers drop the cached data computed for the previous version.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    updated = db.session.query(DataVersion).filter_by(id=DATA_VERSION_ID).update(
+        {DataVersion.version: DataVersion.version + 1, DataVersion.updated_at: now},
+        synchronize_session=False
+    )
+    if not updated:
+        db.session.add(DataVersion(id=DATA_VERSION_ID, version=1, updated_at=now))
+
+class VersionedCache:
+    """A bounded, thread-safe LRU cache whose values are only valid for the data version they were computed for.
+
+    Misses are computed by a single thread per key: concurrent requests for the same key wait
+    for that computation, or with serve_stale get the value of the previous version meanwhile.
+    With max_age, values also expire that many seconds after they were computed.
+    """
+
+    def __init__(self, max_size, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._values = OrderedDict()
+        self._computing = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, version, compute):
+        """Returns the value cached for key and version, computing and storing it on a miss."""
+        return self._get_or_compute(key, version, compute, serve_stale=False)[0]
+
+    def get_or_compute_stale(self, key, version, compute):
+        """Like get_or_compute, but returns the value of an older version while another thread computes the current one.
+
+        Returns a tuple of the value and whether it is stale.
+        """
+        return self._get_or_compute(key, version, compute, serve_stale=True)
+
+    def _get_or_compute(self, key, version, compute, serve_stale):
+        while True:
+            with self._lock:
+                cached = self._values.get(key)
+                if cached is not None and cached[0] == version and (
+                        self.max_age is None or monotonic() - cached[2] < self.max_age):
+                    self._values.move_to_end(key)
+                    self.hits += 1
+                    return cached[1], False
+                in_flight = self._computing.get(key)
+                if in_flight is None:
+                    in_flight = self._computing[key] = Event()
+                    self.misses += 1
+                    break
+                if serve_stale and cached is not None:
+                    self.hits += 1
+                    return cached[1], True
+            # Another thread computes this key, its value is picked up in the next iteration
+            in_flight.wait()
+
+        try:
+            value = compute()
+            with self._lock:
+                self._values[key] = (version, value, monotonic())
+                self._values.move_to_end(key)
+                while len(self._values) > self.max_size:
+                    self._values.popitem(last=False)
+            return value, False
+        finally:
+            with self._lock:
+                del self._computing[key]
+            in_flight.set()
+
+    def discard(self, key):
+        """Removes the value cached for key, e.g. an error that should not be served again."""
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def stats(self):
+        """Returns the number of cached values and the hits and misses since the cache was created."""
+        with self._lock:
+            return {"size": len(self._values), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+def conditional_on_data_version(view):
+    """Adds ETag and Last-Modified headers to a GET view and answers conditional requests with 304.
+
+    The ETag is derived from the data version, today's date and the requested URL, so a
+    matching request is answered after a single version lookup without calling the view.
+    Today's date is part of it because the pivot of the entries moves at midnight.
+    Views that answer with stale content set g.stale_response to skip the validators.
+    While the view runs, the version is kept in g.data_version, so that it can key its caches
+    on it without reading it again.
+
+    Last-Modified only has a granularity of one second, a second write within the same second
+    would keep it. It is therefore only sent and compared once it is a full second old, and
+    ignored when the request has an If-None-Match header.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = get_data_version_info(db)
+        today = date.today()
+        etag = sha1(f"{version}:{today}:{request.host_url}:{request.full_path}".encode()).hexdigest()
+
+        # Responses also change at local midnight, even without a write
+        last_modified = datetime.combine(today, time.min).astimezone(timezone.utc)
+        if updated_at is not None:
+            last_modified = max(last_modified, updated_at.replace(tzinfo=timezone.utc))
+
+        settled = datetime.now(timezone.utc) - last_modified >= timedelta(seconds=1)
+        compare_date = settled and 'HTTP_IF_NONE_MATCH' not in request.environ
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified if compare_date else None):
+            response = make_response('', 304)
+        else:
+            g.data_version = version
+            try:
+                response = make_response(view(*args, **kwargs))
+            finally:
+                g.pop('data_version', None)
+            # Stale content must not be stored under the validators of the current version
+            if response.status_code != 200 or g.pop('stale_response', False):
+                response.cache_control.no_cache = True
+                return response
+        # Weak, since compressed and uncompressed responses share it, so 304 and 200 carry the same validator
+        response.set_etag(etag, weak=True)
+        if settled:
+            response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
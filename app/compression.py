@@ -0,0 +1,165 @@
+import gzip
+import mimetypes
+import os
+import zlib
+from flask import request, send_from_directory
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip is always available
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Dynamic responses, a good trade-off between size and CPU time
+BROTLI_STATIC_QUALITY = 11  # Static files are compressed once at startup
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/javascript', 'image/svg+xml', 'image/vnd.microsoft.icon',
+                          'image/x-icon'}
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.json', '.html', '.svg', '.txt', '.ico', '.map'}
+PRECOMPRESSED_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+STREAM_FLUSH_SIZE = 64 * 1024  # Bytes of a streamed response compressed before the compressor is flushed
+STATIC_FOLDER = os.path.join(os.path.dirname(__file__), 'static')
+
+def is_compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES)
+
+def available_encodings():
+    """Returns the supported content codings, preferred first."""
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+def negotiate_encoding(accept_encodings, encodings):
+    """Returns the encoding out of encodings the client accepts with the highest quality, None for identity."""
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(data, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_STATIC_QUALITY if static else BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if static else GZIP_LEVEL, mtime=0)
+
+def compress_stream(chunks, encoding):
+    """Compresses an iterable of response chunks on the fly.
+
+    The compressor is only flushed after STREAM_FLUSH_SIZE bytes and at the end, every flush
+    costs compression ratio.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress_chunk, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31 writes a gzip container
+        compress_chunk, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    pending = 0
+    for chunk in chunks:
+        data = compress_chunk(chunk)
+        pending += len(chunk)
+        if pending >= STREAM_FLUSH_SIZE:
+            data += flush()
+            pending = 0
+        if data:
+            yield data
+    yield finish()
+
+def precompress_static_files(static_folder):
+    """Writes .gz (and .br) siblings of the compressible static files that are missing or outdated.
+
+    Returns the set of relative paths, with forward slashes, of the variants that exist afterwards.
+    """
+    variants = set()
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            data = None
+            for encoding in available_encodings():
+                variant = path + PRECOMPRESSED_SUFFIXES[encoding]
+                try:
+                    if not os.path.exists(variant) or os.path.getmtime(variant) < os.path.getmtime(path):
+                        if data is None:
+                            with open(path, 'rb') as file:
+                                data = file.read()
+                        with open(variant, 'wb') as file:
+                            file.write(compress(data, encoding, static=True))
+                except OSError:
+                    continue  # A read-only static folder is served uncompressed
+                variants.add(os.path.relpath(variant, static_folder).replace(os.sep, '/'))
+    return variants
+
+def find_precompressed_static_files(static_folder):
+    """Returns the set of relative paths, with forward slashes, of the .gz and .br siblings that are up to date."""
+    variants = set()
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            suffix = os.path.splitext(name)[1]
+            if suffix not in PRECOMPRESSED_SUFFIXES.values():
+                continue
+            path = os.path.join(root, name)
+            original = path[:-len(suffix)]
+            if os.path.exists(original) and os.path.getmtime(path) >= os.path.getmtime(original):
+                variants.add(os.path.relpath(path, static_folder).replace(os.sep, '/'))
+    return variants
+
+def init_compression(app):
+    """Compresses dynamic responses and serves precompressed variants of the static files.
+
+    Both are negotiated from Accept-Encoding, brotli is preferred when the brotli package is installed.
+    The variants are written at build time by running this module, only those found at startup are served.
+    """
+    variants = app.extensions['precompressed_static'] = find_precompressed_static_files(app.static_folder)
+    serve_static = app.view_functions['static']
+
+    def serve_precompressed_static(filename):
+        encodings = [encoding for encoding in available_encodings()
+                     if filename + PRECOMPRESSED_SUFFIXES[encoding] in variants]
+        encoding = negotiate_encoding(request.accept_encodings, encodings)
+        if encoding is None:
+            response = serve_static(filename=filename)
+        else:
+            try:
+                response = send_from_directory(app.static_folder, filename + PRECOMPRESSED_SUFFIXES[encoding],
+                                               mimetype=mimetypes.guess_type(filename)[0])
+            except NotFound:
+                response = serve_static(filename=filename)
+            else:
+                response.headers['Content-Encoding'] = encoding
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    app.view_functions['static'] = serve_precompressed_static
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+                or not is_compressible(response.mimetype) or request.method == 'HEAD'):
+            return response
+        if not response.is_streamed and response.content_length is not None \
+                and response.content_length < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding(request.accept_encodings, available_encodings())
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.iter_encoded(), encoding)
+        else:
+            response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+        # The compressed body differs byte for byte, but is semantically the same representation
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+if __name__ == '__main__':
+    # Build step: python -m app.compression [static folder]
+    import sys
+    folder = sys.argv[1] if len(sys.argv) > 1 else STATIC_FOLDER
+    print(f"Precompressed {len(precompress_static_files(folder))} static files in {folder}")
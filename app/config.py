@@ -1,4 +1,5 @@
 from dotenv import load_dotenv
+import os
 
 class Config:
     load_dotenv()  # This loads the env variables from .env file
@@ -6,11 +7,43 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SCHEDULER_API_ENABLED = True
     UPLOAD_FOLDER = '/app/data/uploads'  # Directory to save uploaded images
+    UPLOAD_SENDFILE_MODE = os.getenv('UPLOAD_SENDFILE_MODE', '').lower()  # '', 'x-sendfile' or 'x-accel-redirect'
+    UPLOAD_ACCEL_REDIRECT_PREFIX = os.getenv('UPLOAD_ACCEL_REDIRECT_PREFIX', '/protected-uploads/')  # Internal nginx location of UPLOAD_FOLDER
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB
+    GIPHY_DOWNLOAD_MAX_BYTES = 16 * 1024 * 1024  # Giphy downloads larger than this are aborted
+    GIPHY_CONNECT_TIMEOUT = 3.05  # Seconds to establish a connection to Giphy
+    GIPHY_READ_TIMEOUT = 10  # Seconds to wait for each chunk from Giphy
+    GIPHY_DOWNLOAD_DEADLINE = 30  # Seconds a Giphy download may take in total
+    GIPHY_SEARCH_URL = os.getenv('GIPHY_SEARCH_URL', 'https://api.giphy.com/v1/gifs/search')  # Giphy search endpoint used by /search_gifs
+    GIPHY_SEARCH_CACHE_TTL = 600  # Seconds search results are reused at most
+    GIPHY_SEARCH_CACHE_SIZE = 256  # Number of search queries cached per worker
+    IMAGE_INGEST_RETRIES = 3  # Retries of a failed Giphy download in the background
+    IMAGE_INGEST_BACKOFF = 5  # Seconds before the first retry, doubled for every further one
+    IMAGE_INGEST_LEASE = 120  # Seconds a worker holds a claimed download before another worker may resume it
+    IMAGE_INGEST_RESUME_INTERVAL = 5  # Minutes between the checks for pending downloads that no worker holds
+    IMAGE_VARIANT_WIDTHS = (320, 640, 1280)  # Widths of the downscaled copies of uploaded images
+    IMAGE_WORKERS = 2  # Threads processing uploaded images per worker process, 0 to process them inline (meant for tests)
+    TRANSCODE_ANIMATED_GIFS = os.getenv('TRANSCODE_ANIMATED_GIFS', 'true').lower() == 'true'  # Serve animated GIFs as animated WebP when smaller
+    TIMELINE_IMAGE_WIDTH = 640  # Minimum width of the image variant used as timeline card background
+    ADMIN_IMAGE_WIDTH = 320  # Minimum width of the image variant shown in the admin entry list
+    API_ENTRIES_DEFAULT_LIMIT = 100  # Default page size of /api/entries
+    API_ENTRIES_MAX_LIMIT = 1000  # Maximum page size of /api/entries
+    ENTRY_DATA_CACHE_SIZE = 64  # Number of entry windows cached per worker
+    TIMELINE_CACHE_SIZE = 32  # Number of rendered timeline pages cached per worker
+    TIMELINE_LOCALE = os.getenv('TIMELINE_LOCALE', 'de_DE')  # Default locale for formatted entry dates
+    TIMELINE_DATE_FORMAT = os.getenv('TIMELINE_DATE_FORMAT', 'd. MMMM')  # Babel date pattern for formatted entry dates
+    DATE_FORMAT_PREWARM_DAYS = 60  # Days before and after today formatted at startup
+    GRAFANA_ANNOTATIONS_LIMIT = 1000  # Maximum number of annotations returned per request
+    GRAFANA_TAG_VALUES_LIMIT = 100  # Maximum number of tag values returned per request
+    GRAFANA_CACHE_SIZE = 128  # Number of Grafana responses cached per worker
+    GRAFANA_CACHE_MAX_RESPONSE_SIZE = 256 * 1024  # Larger Grafana responses are not cached, bounding the cache's memory
+    BATCH_IMPORT_CHUNK_SIZE = 5000  # Entries or quotes inserted and committed together by /batch-import
+    COMPRESSION_MIN_SIZE = 1024  # Dynamic responses smaller than this many bytes are sent uncompressed
 
 # for unittests
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'  # Use an in-memory database for tests
+    IMAGE_WORKERS = 0  # Background threads would not see the in-memory database
     WTF_CSRF_ENABLED = False  # Disable CSRF tokens in the form
\ No newline at end of file
@@ -1,41 +1,110 @@
-from datetime import datetime, date
-from flask import jsonify, url_for
+from datetime import datetime, date, time, timedelta
+from flask import url_for, current_app, request, has_request_context
+from babel.core import Locale, UnknownLocaleError
 from babel.dates import format_date
+from functools import lru_cache
+import os
 from os import path, makedirs
+from hashlib import sha1
 import zipfile
 from io import BytesIO
-from urllib.parse import urlparse, unquote_plus
+from itertools import chain
+from types import GeneratorType
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from urllib.parse import urlparse, unquote_plus, quote
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tempfile import mkstemp
+from time import monotonic
 from werkzeug.utils import secure_filename
 from colorsys import rgb_to_hls, hls_to_rgb
 from .models import Entry, Category
-from sqlalchemy.orm import joinedload
+from .cache import current_data_version
+from .images import variant_width
+from sqlalchemy import select, func, tuple_
 
+STREAM_BATCH_SIZE = 500  # Rows fetched per round trip when streaming entries
+JSON_STREAM_CHUNK_SIZE = 32 * 1024  # Characters of encoded JSON collected before a streamed chunk is sent
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes read at a time when downloading images
+HTTP_RETRIES = 3  # Retries of outgoing requests after connection errors and transient server errors
+GIPHY_SEARCH_LIMIT = 15  # GIFs returned per search
+# Columns read for the JSON representation of entries, without hydrating ORM objects (entry_formatter unpacks them in this order)
+ENTRY_COLUMNS = (
+    Entry.id, Entry.date, Entry.category_id, Entry.title, Entry.description,
+    Entry.url, Entry.image_filename, Entry.image_variants, Entry.pending_image_url, Entry.cancelled, Entry.last_updated_by
+)
+# Attributes of formatted entries that can be selected with get_entry_data(fields=...)
+ENTRY_FIELDS = (
+    'id', 'date', 'date_formatted', 'title', 'description', 'category', 'url',
+    'image_url', 'image_url_external', 'image_variants', 'image_pending', 'index', 'is_today', 'cancelled', 'last_updated_by'
+)
+# In the compact format the category is referenced by its id
+COMPACT_ENTRY_FIELDS = tuple('category_id' if field == 'category' else field for field in ENTRY_FIELDS)
+DATE_FORMAT_CACHE_SIZE = 4096  # Formatted dates kept in memory, about ten years of days for one locale
 
-def handle_image_upload(entry_id, file, giphy_url, upload_folder, allowed_extensions):
-    """Handle Giphy URL or file upload."""
-    if giphy_url:
-        filename = download_giphy_image(giphy_url, entry_id, upload_folder)
-    else:
-        filename = handle_image(file, entry_id, upload_folder, allowed_extensions)
 
-    return filename
+def create_http_session(retries):
+    """Creates a keep-alive session that retries failed connections and transient server errors with backoff."""
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',), raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+http_session = create_http_session(HTTP_RETRIES)  # Shared by all outgoing requests of a worker process
+
+def download_giphy_image(url, entry_id, upload_folder, filename=None):
+    """Download and save a Giphy image from a valid URL to the specified folder, as <entry_id>.gif unless filename is given.
 
-def download_giphy_image(url, entry_id, upload_folder):
-    """Download and save a Giphy image from a valid URL to the specified folder."""
+    The body is streamed to a temporary file and renamed into place once complete. Downloads exceeding
+    GIPHY_DOWNLOAD_MAX_BYTES or GIPHY_DOWNLOAD_DEADLINE seconds are aborted.
+    """
     if not is_valid_giphy_url(url):
         return None
+    config = current_app.config
+    max_bytes = config['GIPHY_DOWNLOAD_MAX_BYTES']
+    deadline = monotonic() + config['GIPHY_DOWNLOAD_DEADLINE']
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            filename = f"{entry_id}.gif"
-            filepath = path.join(upload_folder, filename)
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
+        with http_session.get(url, stream=True, timeout=(config['GIPHY_CONNECT_TIMEOUT'], config['GIPHY_READ_TIMEOUT'])) as response:
+            if response.status_code != 200 or int(response.headers.get('Content-Length') or 0) > max_bytes:
+                return None
+            filename = filename or f"{entry_id}.gif"
+            fd, temp_path = mkstemp(dir=upload_folder, prefix=f".{entry_id}-", suffix='.part')
+            try:
+                size = 0
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > max_bytes or monotonic() > deadline:
+                            current_app.logger.warning(f"Aborted the download of {url}, too large or too slow")
+                            return None
+                        f.write(chunk)
+                os.replace(temp_path, path.join(upload_folder, filename))
+            finally:
+                if path.exists(temp_path):
+                    os.remove(temp_path)
             return filename
-    except requests.RequestException:
+    except (requests.RequestException, ValueError, OSError):
         return None
 
+def normalize_search_query(query):
+    """Normalizes a search query for caching: lower case, whitespace collapsed, at most 50 characters."""
+    return ' '.join(query.lower().split())[:50]
+
+def search_giphy(query):
+    """Searches Giphy through the shared session and returns the found GIFs serialized as JSON array."""
+    config = current_app.config
+    response = http_session.get(
+        config['GIPHY_SEARCH_URL'],
+        params={'api_key': os.getenv('GIPHY_API_TOKEN'), 'q': query, 'limit': GIPHY_SEARCH_LIMIT},
+        timeout=(config['GIPHY_CONNECT_TIMEOUT'], config['GIPHY_READ_TIMEOUT'])
+    )
+    response.raise_for_status()
+    return current_app.json.dumps(response.json()['data'])
+
 def is_valid_giphy_url(url):
     """Check if a URL is a valid Giphy URL by its domain and path."""
     try:
@@ -55,6 +124,14 @@ def handle_image(file, entry_id, upload_folder, allowed_extensions):
         return filename
     return None
 
+def upload_revision(upload_folder, filename):
+    """Returns a short revision of an uploaded file that changes whenever the file is replaced, None if it is missing."""
+    try:
+        stat = os.stat(path.join(upload_folder, filename))
+    except (OSError, ValueError):
+        return None
+    return sha1(f"{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()[:12]
+
 def parse_date(date_str):
     """Parses a date string formatted as 'YYYY-MM-DD' into a date object."""
     try:
@@ -62,6 +139,21 @@ def parse_date(date_str):
     except ValueError:
         return None
 
+def move_to_year(value, year):
+    """Returns the date moved to the given year, mapping 29 February to 28 February in non-leap years."""
+    try:
+        return value.replace(year=year)
+    except ValueError:
+        return value.replace(year=year, day=28)
+
+@lru_cache(maxsize=DATE_FORMAT_CACHE_SIZE)
+def date_to_millis(value):
+    """Converts a date into milliseconds since the epoch at local midnight, as expected by Grafana.
+
+    Cached, since time series and annotations convert the same few days over and over.
+    """
+    return datetime.combine(value, time.min).timestamp() * 1000
+
 def allowed_file(filename, allowed_extensions):
     """Checks if a file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
@@ -71,92 +163,248 @@ def create_upload_folder(upload_folder):
     if not path.exists(upload_folder):
         makedirs(upload_folder, exist_ok=True)
 
-def get_entry_data(db, category_filter=None, max_past_entries=None):
+def get_entry_data(db, category_filter=None, max_past_entries=None, max_future_entries=None, days_back=None, days_ahead=None, locale=None, compact=False, fields=None, stream=False):
     """Returns formatted entries and categories data with complete category details for each entry.
     
-    If max_past_entries is provided, only the most recent past entries up to that count will be included.
+    The past and upcoming entries are fetched as two bounded queries around today's date:
+    max_past_entries and max_future_entries limit the number of entries on either side,
+    days_back and days_ahead limit how far the window reaches into the past and the future.
+    Dates are formatted for the given locale, TIMELINE_LOCALE by default.
+
+    If compact is set, entries reference their category by "category_id" instead of
+    embedding it. If fields is given, entries only contain these attributes.
+
+    If stream is set, "entries" is a generator that formats the entries while they are
+    read from the database in batches of STREAM_BATCH_SIZE rows, to be encoded with iter_json.
     """
-    # Parse the category_filter if provided
-    filter_categories = category_filter.split(',') if category_filter else None
+    formatted_categories = [format_category(category) for category in db.session.query(Category).all()]
+    entries = iter_entry_window(db, formatted_categories, category_filter, max_past_entries, max_future_entries,
+                                days_back, days_ahead, locale, compact, fields, STREAM_BATCH_SIZE if stream else None)
 
-    # Preload categories to avoid N+1 query issues
-    query = db.session.query(Entry).options(joinedload(Entry.category)).order_by(Entry.date)
-    
-    if filter_categories:
-        # Filter entries based on the category names
-        query = query.join(Category).filter(Category.name.in_(filter_categories))
-    
-    entries = query.all()
-    categories = db.session.query(Category).all()
+    return {"entries": entries if stream else list(entries), "categories": formatted_categories}
 
-    # Determine the pivot: the first upcoming or current entry (based on today’s date)
-    today_str = str(date.today())
-    pivot = next((i for i, entry in enumerate(entries) if entry.date >= today_str), len(entries))
-    
-    # Split past and upcoming entries. Limit past entries if max_past_entries is provided.
-    past_entries = entries[:pivot]
-    future_entries = entries[pivot:]
+def get_cached_entry_data(db, **window_args):
+    """Returns get_entry_data for the given window, cached per worker until the data version changes.
+
+    The cache key contains today's date, because the pivot moves at midnight, and the host
+    the request was made for, because of the external image URLs.
+    """
+    key = (
+        request.host_url if has_request_context() else None,
+        date.today(),
+        tuple(sorted(window_args.items()))
+    )
+    cache = current_app.extensions['entry_data_cache']
+    return cache.get_or_compute(key, current_data_version(db), lambda: get_entry_data(db, **window_args))
+
+def iter_entry_window(db, formatted_categories, category_filter, max_past_entries, max_future_entries, days_back, days_ahead, locale=None, compact=False, fields=None, batch_size=None):
+    """Yields the formatted entries of the window around today's date in date order.
+
+    Entries are read as plain column rows instead of ORM objects. Without a batch_size the
+    rows of each query are loaded at once, otherwise they are fetched in batches of that
+    size from a server-side cursor.
+    """
+    conditions = []
+    if category_filter:
+        # Filter entries based on the category ids so the (category_id, date) index can be used
+        filter_categories = category_filter.split(',')
+        category_ids = [category['id'] for category in formatted_categories if category['name'] in filter_categories]
+        conditions.append(Entry.category_id.in_(category_ids))
+
+    # Split past and upcoming entries at the pivot (today's date) directly in the database
+    today = date.today()
+
+    past_conditions = conditions + [Entry.date < today]
+    if days_back is not None:
+        past_conditions.append(Entry.date >= today - timedelta(days=days_back))
+
+    future_conditions = conditions + [Entry.date >= today]
+    if days_ahead is not None:
+        future_conditions.append(Entry.date <= today + timedelta(days=days_ahead))
+    future_statement = select(*ENTRY_COLUMNS).where(*future_conditions).order_by(Entry.date, Entry.id)
+    if max_future_entries is not None:
+        future_statement = future_statement.limit(max_future_entries)
+
+    past_statement = select(*ENTRY_COLUMNS).where(*past_conditions)
+    execution_options = {"yield_per": batch_size} if batch_size else {}
+
+    # The pivot is the count of past entries kept, it is known before streaming the first row
     if max_past_entries is not None:
-        past_entries = past_entries[-max_past_entries:]
-    filtered_entries = past_entries + future_entries
-    # The pivot for the filtered list is now the count of past entries kept
-    filtered_pivot = len(past_entries)
-    
-    formatted_entries = [{
-        "id": entry.id,
-        "date": entry.date,
-        "date_formatted": format_date(parse_date(entry.date), 'd. MMMM', locale='de_DE'),
-        "title": entry.title,
-        "description": entry.description,
-        "category": {
-            "id": entry.category.id,
-            "name": entry.category.name,
-            "symbol": entry.category.symbol,
-            "color_hex": entry.category.color_hex,
-            "color_hex_variation": adjust_lightness(entry.category.color_hex),
-            "repeat_annually": entry.category.repeat_annually,
-            "display_celebration": entry.category.display_celebration,
-            "is_protected": entry.category.is_protected,
-            "last_updated_by": entry.category.last_updated_by
-        },
-        "url": entry.url,
-        "image_url": url_for('uploaded_file', filename=entry.image_filename) if entry.image_filename else None,
-        "image_url_external": url_for('uploaded_file', filename=entry.image_filename, _external=True) if entry.image_filename else None,
-        "index": i - filtered_pivot,
-        "is_today": entry.date == today_str,
-        "cancelled": entry.cancelled,
-        "last_updated_by": entry.last_updated_by
-    } for i, entry in enumerate(filtered_entries)]
+        past_statement = past_statement.order_by(Entry.date.desc(), Entry.id.desc()).limit(max_past_entries)
+        past_entries = db.session.execute(past_statement).all()[::-1]
+        pivot = len(past_entries)
+    elif batch_size:
+        pivot = db.session.execute(select(func.count(Entry.id)).where(*past_conditions)).scalar()
+        past_entries = db.session.execute(past_statement.order_by(Entry.date, Entry.id), execution_options=execution_options)
+    else:
+        past_entries = db.session.execute(past_statement.order_by(Entry.date, Entry.id)).all()
+        pivot = len(past_entries)
+    future_entries = db.session.execute(future_statement, execution_options=execution_options)
+
+    format_entry = entry_formatter(formatted_categories, today, locale, compact)
+    for i, entry in enumerate(chain(past_entries, future_entries)):
+        formatted_entry = format_entry(entry)
+        formatted_entry["index"] = i - pivot
+        if fields:
+            formatted_entry = {field: formatted_entry[field] for field in fields if field in formatted_entry}
+        yield formatted_entry
+
+def get_entry_page(db, date_from=None, date_to=None, category_filter=None, limit=100, cursor=None):
+    """Returns one page of formatted entries ordered by (date, id) and the cursor of the next page.
     
-    formatted_categories = [{
+    Pages are fetched with keyset pagination: the cursor encodes the (date, id) of the last
+    entry of the previous page, so every page is an index range scan regardless of its position.
+    """
+    formatted_categories = [format_category(category) for category in db.session.query(Category).all()]
+    statement = select(*ENTRY_COLUMNS)
+
+    if category_filter:
+        filter_categories = category_filter.split(',')
+        category_ids = [category['id'] for category in formatted_categories if category['name'] in filter_categories]
+        statement = statement.where(Entry.category_id.in_(category_ids))
+    if date_from is not None:
+        statement = statement.where(Entry.date >= date_from)
+    if date_to is not None:
+        statement = statement.where(Entry.date <= date_to)
+    if cursor is not None:
+        statement = statement.where(tuple_(Entry.date, Entry.id) > cursor)
+
+    # Fetch one extra row to find out whether there is a next page
+    entries = db.session.execute(statement.order_by(Entry.date, Entry.id).limit(limit + 1)).all()
+    next_cursor = encode_cursor(entries[limit - 1]) if len(entries) > limit else None
+
+    format_entry = entry_formatter(formatted_categories, date.today())
+    return {
+        "entries": [format_entry(entry) for entry in entries[:limit]],
+        "next_cursor": next_cursor
+    }
+
+def encode_cursor(entry):
+    """Encodes the (date, id) position of an entry into an opaque pagination cursor."""
+    return urlsafe_b64encode(f"{entry.date.isoformat()}:{entry.id}".encode()).decode()
+
+def decode_cursor(cursor):
+    """Decodes a pagination cursor into its (date, id) position, returns None if it is invalid."""
+    try:
+        date_str, entry_id = urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return date.fromisoformat(date_str), int(entry_id)
+    except ValueError:
+        return None
+
+def entry_formatter(formatted_categories, today, locale=None, compact=False):
+    """Returns a function that builds the JSON representation of an entry row including its complete category details.
+
+    Everything that is the same for all entries is resolved once: the categories are looked up
+    by id in the already formatted categories and image URLs are built from precomputed prefixes
+    instead of calling url_for for every entry. In compact mode the category is referenced by
+    "category_id" instead.
+    """
+    categories_by_id = {category['id']: category for category in formatted_categories}
+    locale = locale or current_app.config['TIMELINE_LOCALE']
+    pattern = current_app.config['TIMELINE_DATE_FORMAT']
+    image_url_prefixes = []
+
+    def image_urls(image_filename):
+        if not image_url_prefixes:
+            # The prefixes are built once with a placeholder filename that is cut off again
+            image_url_prefixes.append(url_for('uploaded_file', filename='_')[:-1])
+            image_url_prefixes.append(url_for('uploaded_file', filename='_', _external=True)[:-1])
+        revision = upload_revision(current_app.config['UPLOAD_FOLDER'], image_filename)
+        suffix = f"?v={revision}" if revision else ""
+        return [prefix + quote(image_filename) + suffix for prefix in image_url_prefixes]
+
+    def format_entry(entry):
+        # Unpacking the row is considerably faster than attribute access by column name
+        (entry_id, day, category_id, title, description, url, image_filename, image_variants, pending_image_url,
+         cancelled, last_updated_by) = entry
+        image_url, image_url_external = image_urls(image_filename) if image_filename else (None, None)
+        variants = [{"width": variant_width(variant), "url": image_urls(variant)[0]}
+                    for variant in image_variants.split(',')] if image_filename and image_variants else []
+        formatted_entry = {
+            "id": entry_id,
+            "date": day.isoformat(),
+            "date_formatted": format_entry_date(day, locale, pattern),
+            "title": title,
+            "description": description,
+            "url": url,
+            "image_url": image_url,
+            "image_url_external": image_url_external,
+            "image_variants": variants,
+            "image_pending": pending_image_url is not None,
+            "is_today": day == today,
+            "cancelled": cancelled,
+            "last_updated_by": last_updated_by
+        }
+        if compact:
+            formatted_entry["category_id"] = category_id
+        else:
+            formatted_entry["category"] = categories_by_id[category_id]
+        return formatted_entry
+
+    return format_entry
+
+@lru_cache(maxsize=DATE_FORMAT_CACHE_SIZE)
+def format_entry_date(day, locale, pattern):
+    """Formats a date with Babel, cached per (date, locale, pattern) since entries repeat the same few days."""
+    return format_date(day, pattern, locale=locale)
+
+def prewarm_date_formats(first_day, days, locale, pattern):
+    """Fills the date format cache for the given number of days starting at first_day."""
+    for offset in range(days):
+        format_entry_date(first_day + timedelta(days=offset), locale, pattern)
+
+@lru_cache(maxsize=64)
+def is_known_locale(locale):
+    """Checks if Babel has data for a locale identifier such as 'de_DE' or 'en'."""
+    try:
+        Locale.parse(locale)
+        return True
+    except (ValueError, TypeError, UnknownLocaleError):
+        return False
+
+def format_category(category):
+    """Returns the JSON representation of a category.
+
+    The gradient variation is stored when a category is saved, it is only computed here
+    for rows that were inserted without it.
+    """
+    return {
         "id": category.id,
         "name": category.name,
         "symbol": category.symbol,
         "color_hex": category.color_hex,
-        "color_hex_variation": adjust_lightness(category.color_hex),
+        "color_hex_variation": category.color_hex_variation or adjust_lightness(category.color_hex),
         "repeat_annually": category.repeat_annually,
         "display_celebration": category.display_celebration,
         "is_protected": category.is_protected,
         "last_updated_by": category.last_updated_by
-    } for category in categories]
-
-    return {"entries": formatted_entries, "categories": formatted_categories}
+    }
     
 def create_zip(data, upload_folder, db_uri):
-    """Creates a zip file containing entries data, associated images, and the database file."""
+    """Creates a zip file containing entries data, associated images, and the database file.
+
+    The values of data may be generators, data.json is then written while they are consumed.
+    """
+    image_filenames = []
+
+    def track_images(entries):
+        for entry in entries:
+            if entry['image_url']:
+                image_filenames.append(unquote_plus(entry['image_url'].split('?')[0].split('/')[-1]))
+            yield entry
+
     zip_buffer = BytesIO()
     with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
         # Add entries.json file
-        entries_json = jsonify(data).get_data(as_text=True)
-        zip_file.writestr('data.json', entries_json)
+        with zip_file.open('data.json', 'w') as json_file:
+            for chunk in iter_json(dict(data, entries=track_images(data.get('entries', [])))):
+                json_file.write(chunk.encode())
         
         # Add image files
-        for entry in data.get('entries'):
-            if entry['image_url']:
-                image_filename = entry['image_url'].split('/')[-1]
-                image_path = path.join(upload_folder, image_filename)
-                if path.exists(image_path):
-                    zip_file.write(image_path, arcname=image_filename)
+        for image_filename in image_filenames:
+            image_path = path.join(upload_folder, image_filename)
+            if path.exists(image_path):
+                zip_file.write(image_path, arcname=image_filename)
 
         # Add the database file if the URI points to a SQLite database
         if db_uri.startswith("sqlite:///"):
@@ -167,6 +415,40 @@ def create_zip(data, upload_folder, db_uri):
     zip_buffer.seek(0)
     return zip_buffer
 
+def iter_json(value, chunk_size=JSON_STREAM_CHUNK_SIZE):
+    """Encodes a value as JSON in chunks of about chunk_size characters, expanding generators element by element.
+
+    Only one element of a generator is held in memory at a time, everything else is encoded
+    with the application's JSON provider just like jsonify does.
+    """
+    buffer, size = [], 0
+    for piece in iter_json_pieces(value):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def iter_json_pieces(value):
+    """Encodes a value as JSON, each element of a generator, and of a dict holding generators, as a piece of its own."""
+    if isinstance(value, GeneratorType):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ','
+            yield from iter_json_pieces(item)
+        yield ']'
+    elif isinstance(value, dict) and any(isinstance(item, GeneratorType) for item in value.values()):
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            yield (',' if i else '') + current_app.json.dumps(str(key)) + ':'
+            yield from iter_json_pieces(item)
+        yield '}'
+    else:
+        yield current_app.json.dumps(value, separators=(',', ':'))
+
 def hex_to_rgb(value):
     """Convert hex to RGB"""
     value = value.lstrip('#')
@@ -0,0 +1,244 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from hashlib import sha1
+from os import path
+from threading import Timer
+from flask import current_app
+from sqlalchemy import or_
+from PIL import Image, ImageOps, features
+from app import db
+from .cache import bump_data_version
+from .models import Entry
+
+VARIANT_QUALITY = 80
+ANIMATION_QUALITY = 75  # Lossy animated WebP, visually close to the GIF at a fraction of its size
+
+def variant_filename(image_filename, width, extension):
+    """Returns the filename of the downscaled variant of an uploaded image, e.g. 1.w320.webp for 1.png."""
+    return f"{image_filename.rsplit('.', 1)[0]}.w{width}.{extension}"
+
+def variant_width(filename):
+    """Returns the width encoded in a variant filename."""
+    return int(filename.rsplit('.', 2)[1][1:])
+
+def generate_image_variants(upload_folder, image_filename, widths):
+    """Writes downscaled copies of an uploaded image for all widths below its own width.
+
+    Variants are WebP, or JPEG if Pillow was built without WebP support. Animated images are skipped,
+    a still variant would lose the animation. Returns the variant filenames, narrowest first.
+    """
+    image_format, extension = ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+    variants = []
+    with Image.open(path.join(upload_folder, image_filename)) as image:
+        if getattr(image, 'is_animated', False):
+            return variants
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA') or image_format == 'JPEG':
+            image = image.convert('RGBA' if image_format == 'WEBP' and 'A' in image.getbands() else 'RGB')
+        for width in sorted(widths):
+            if width >= image.width:
+                break
+            filename = variant_filename(image_filename, width, extension)
+            filepath = path.join(upload_folder, filename)
+            resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            # Written under a temporary name, so a variant is never served half written
+            resized.save(filepath + '.tmp', format=image_format, quality=VARIANT_QUALITY)
+            os.replace(filepath + '.tmp', filepath)
+            variants.append(filename)
+    return variants
+
+def transcode_animated_gif(upload_folder, image_filename):
+    """Converts an animated GIF to an animated WebP next to it, e.g. 1.webp for 1.gif.
+
+    Returns the WebP filename, or None if the image is no animated GIF or the WebP is not smaller,
+    in which case nothing is written and the GIF stays in use.
+    """
+    if not features.check('webp'):
+        return None
+    webp_filename = f"{image_filename.rsplit('.', 1)[0]}.webp"
+    filepath = path.join(upload_folder, webp_filename)
+    with Image.open(path.join(upload_folder, image_filename)) as image:
+        if image.format != 'GIF' or not getattr(image, 'is_animated', False):
+            return None
+        image.save(filepath + '.tmp', format='WEBP', save_all=True, quality=ANIMATION_QUALITY, method=4,
+                   loop=image.info.get('loop', 0))
+    if os.path.getsize(filepath + '.tmp') >= os.path.getsize(path.join(upload_folder, image_filename)):
+        os.remove(filepath + '.tmp')
+        return None
+    os.replace(filepath + '.tmp', filepath)
+    return webp_filename
+
+def remove_uploads(upload_folder, filenames):
+    for filename in filenames:
+        filepath = path.join(upload_folder, filename)
+        if path.exists(filepath):
+            os.remove(filepath)
+
+def remove_entry_image(upload_folder, image_filename, image_variants):
+    """Deletes an uploaded image together with its variants."""
+    remove_uploads(upload_folder, [image_filename] + (image_variants.split(',') if image_variants else []))
+
+def pick_image_variant(entry, min_width):
+    """Returns the URL of the narrowest variant of a formatted entry's image that is at least min_width wide.
+
+    Falls back to the original, which is then the next larger image.
+    """
+    for variant in entry.get('image_variants') or ():
+        if variant['width'] >= min_width:
+            return variant['url']
+    return entry.get('image_url')
+
+def process_entry_image(app, entry_id, image_filename):
+    """Prepares an entry's image for serving and records the result on the entry.
+
+    Animated GIFs are transcoded to animated WebP if TRANSCODE_ANIMATED_GIFS is set and the WebP is smaller,
+    still images get downscaled variants.
+    """
+    with app.app_context():
+        upload_folder = app.config['UPLOAD_FOLDER']
+        filename = image_filename
+        try:
+            if app.config['TRANSCODE_ANIMATED_GIFS']:
+                filename = transcode_animated_gif(upload_folder, image_filename) or image_filename
+            variants = generate_image_variants(upload_folder, filename, app.config['IMAGE_VARIANT_WIDTHS'])
+            with Image.open(path.join(upload_folder, filename)) as image:
+                image_format = image.format.lower()
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            app.logger.warning(f"Failed to process image {image_filename}: {e}")
+            if filename != image_filename:
+                remove_uploads(upload_folder, [filename])
+            return
+
+        written = variants + ([filename] if filename != image_filename else [])
+        updated = db.session.query(Entry).filter_by(id=entry_id, image_filename=image_filename).update(
+            {Entry.image_filename: filename, Entry.image_format: image_format,
+             Entry.image_variants: ','.join(variants) or None},
+            synchronize_session=False
+        )
+        if updated:
+            bump_data_version(db)
+            db.session.commit()
+            if filename != image_filename:
+                remove_uploads(upload_folder, [image_filename])
+        else:
+            # The image was replaced or the entry deleted while it was processed
+            db.session.rollback()
+            remove_uploads(upload_folder, written)
+
+def claim_image_ingestion(app, entry_id, url, claim=None):
+    """Takes over the pending download of url for an entry, so that only one worker runs it.
+
+    Succeeds if no worker holds the download or its lease of IMAGE_INGEST_LEASE seconds expired,
+    or, to renew it for a retry, if the claim passed in is still the current one. Returns the new
+    claim, None if the entry waits for another URL or another worker holds the download.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if claim is None:
+        available = or_(Entry.pending_image_claimed_at.is_(None),
+                        Entry.pending_image_claimed_at < now - timedelta(seconds=app.config['IMAGE_INGEST_LEASE']))
+    else:
+        available = Entry.pending_image_claimed_at == claim
+    claimed = db.session.query(Entry).filter(Entry.id == entry_id, Entry.pending_image_url == url, available).update(
+        {Entry.pending_image_claimed_at: now}, synchronize_session=False
+    )
+    db.session.commit()
+    return now if claimed else None
+
+def ingest_giphy_image(app, entry_id, url, attempt=0, claim=None):
+    """Downloads the pending Giphy image of an entry and processes it, rescheduling itself with backoff on failure.
+
+    The download is claimed first, a worker that cannot claim it leaves it to the one that did.
+    The image is only assigned while the entry still waits for this URL. After the last failed
+    attempt the pending state is cleared, so the entry ends up without image. Without image
+    workers, a failed download keeps its claim and is retried by resume_image_ingestion once
+    the claim expired.
+    """
+    # Imported here, the helpers depend on this module
+    from .helpers import download_giphy_image
+
+    with app.app_context():
+        claim = claim_image_ingestion(app, entry_id, url, claim)
+        if claim is None:
+            return  # The entry was deleted, got another image or another worker downloads it
+        upload_folder = app.config['UPLOAD_FOLDER']
+        # Named after the URL, so that concurrent downloads for the same entry never write the same file
+        filename = f"{entry_id}-{sha1(url.encode()).hexdigest()[:8]}.gif"
+        downloaded = download_giphy_image(url, entry_id, upload_folder, filename)
+        if not downloaded:
+            app.logger.warning(f"Failed to download {url} for entry {entry_id}, attempt {attempt + 1}")
+            if attempt < app.config['IMAGE_INGEST_RETRIES']:
+                # Waits outside of the worker pool, so that other images are processed meanwhile
+                if not submit_image_job_later(app.config['IMAGE_INGEST_BACKOFF'] * 2 ** attempt,
+                                              ingest_giphy_image, entry_id, url, attempt + 1, claim):
+                    app.logger.info(f"Leaving {url} for entry {entry_id} to be resumed once its claim expired")
+                return
+
+        updated = db.session.query(Entry).filter_by(id=entry_id, pending_image_url=url).update(
+            {Entry.pending_image_url: None, Entry.pending_image_claimed_at: None, Entry.image_filename: downloaded,
+             Entry.image_variants: None, Entry.image_format: None},
+            synchronize_session=False
+        )
+        if updated:
+            bump_data_version(db)
+            db.session.commit()
+            if downloaded:
+                process_entry_image(app, entry_id, downloaded)
+        else:
+            current = db.session.query(Entry.image_filename).filter_by(id=entry_id).scalar()
+            db.session.rollback()
+            if downloaded and current != downloaded:
+                remove_uploads(upload_folder, [downloaded])
+
+def submit_image_job(job, *args):
+    """Runs an image job with the current app in the background, inline if IMAGE_WORKERS is 0.
+
+    Has to be called after the entry was committed, the worker reads it in its own session.
+    """
+    app = current_app._get_current_object()
+    executor = app.extensions.get('image_executor')
+    if executor is None:
+        job(app, *args)
+    else:
+        executor.submit(job, app, *args)
+
+def submit_image_job_later(delay, job, *args):
+    """Runs an image job after delay seconds, without holding a worker while waiting.
+
+    Returns False without running the job if IMAGE_WORKERS is 0, inline jobs would wait on the request thread.
+    """
+    app = current_app._get_current_object()
+    executor = app.extensions.get('image_executor')
+    if executor is None:
+        return False
+    timer = Timer(delay, executor.submit, (job, app, *args))
+    timer.daemon = True
+    timer.start()
+    return True
+
+def schedule_image_processing(entry_id, image_filename):
+    """Generates variants of an entry's saved image, or transcodes it, in the background."""
+    submit_image_job(process_entry_image, entry_id, image_filename)
+
+def schedule_image_ingestion(entry_id, url):
+    """Downloads the pending Giphy image of an entry in the background."""
+    submit_image_job(ingest_giphy_image, entry_id, url)
+
+def resume_image_ingestion():
+    """Schedules the pending downloads that no worker holds, e.g. because the app stopped while they were running.
+
+    Every worker may call this, each download is only run by the worker that claims it.
+    """
+    expired = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=current_app.config['IMAGE_INGEST_LEASE'])
+    pending = db.session.query(Entry.id, Entry.pending_image_url).filter(
+        Entry.pending_image_url.isnot(None),
+        or_(Entry.pending_image_claimed_at.is_(None), Entry.pending_image_claimed_at < expired)
+    ).all()
+    for entry_id, url in pending:
+        schedule_image_ingestion(entry_id, url)
+
+def init_image_processing(app):
+    """Creates the worker pool for image processing and the image_variant template filter."""
+    workers = app.config['IMAGE_WORKERS']
+    app.extensions['image_executor'] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images') if workers else None
+    app.add_template_filter(pick_image_variant, 'image_variant')
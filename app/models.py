@@ -13,10 +13,11 @@ class CategoryConstants:
     MAX_COLOR_HEX_LENGTH = 10
 
 class EntryConstants:
-    MAX_DATE_LENGTH = 100
     MAX_TITLE_LENGTH = 200
     MAX_DESCRIPTION_LENGTH = 1000
     MAX_IMAGE_FILENAME_LENGTH = 100
+    MAX_IMAGE_VARIANTS_LENGTH = 400
+    MAX_IMAGE_FORMAT_LENGTH = 10
     MAX_URL_LENGTH = 1000
 
 # Common constants
@@ -27,19 +28,28 @@ class Category(db.Model):
     name = db.Column(db.String(CategoryConstants.MAX_NAME_LENGTH), unique=True, nullable=False)
     symbol = db.Column(db.String(CategoryConstants.MAX_SYMBOL_LENGTH), nullable=False)
     color_hex = db.Column(db.String(CategoryConstants.MAX_COLOR_HEX_LENGTH), nullable=False)
+    color_hex_variation = db.Column(db.String(CategoryConstants.MAX_COLOR_HEX_LENGTH), nullable=True)  # Darker gradient end, derived from color_hex
     repeat_annually = db.Column(db.Boolean, default=False, nullable=False)
     display_celebration = db.Column(db.Boolean, default=False, nullable=False)
     is_protected = db.Column(db.Boolean, default=False, nullable=False)
     last_updated_by = db.Column(db.String(MAX_LAST_UPDATED_BY_LENGTH), nullable=True)
 
 class Entry(db.Model):
+    __table_args__ = (
+        db.Index('ix_entry_category_id_date', 'category_id', 'date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.String(EntryConstants.MAX_DATE_LENGTH), nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     category = db.relationship('Category', backref=db.backref('entries', lazy=True))
     title = db.Column(db.String(EntryConstants.MAX_TITLE_LENGTH), nullable=False)
     description = db.Column(db.String(EntryConstants.MAX_DESCRIPTION_LENGTH), nullable=True)
     image_filename = db.Column(db.String(EntryConstants.MAX_IMAGE_FILENAME_LENGTH), nullable=True)
+    pending_image_url = db.Column(db.String(EntryConstants.MAX_URL_LENGTH), nullable=True)  # Giphy URL that is still being downloaded
+    pending_image_claimed_at = db.Column(db.DateTime, nullable=True)  # UTC time a worker took over the download, see IMAGE_INGEST_LEASE
+    image_format = db.Column(db.String(EntryConstants.MAX_IMAGE_FORMAT_LENGTH), nullable=True)  # Format of the served image, set once it was processed
+    image_variants = db.Column(db.String(EntryConstants.MAX_IMAGE_VARIANTS_LENGTH), nullable=True)  # Comma-separated filenames of the downscaled copies
     url = db.Column(db.String(EntryConstants.MAX_URL_LENGTH), nullable=True)
     cancelled = db.Column(db.Boolean, nullable=False, default=False)
     last_updated_by = db.Column(db.String(MAX_LAST_UPDATED_BY_LENGTH), nullable=True)
@@ -52,3 +62,19 @@ class Quote(db.Model):
     url = db.Column(db.String(QuoteConstants.MAX_URL_LENGTH), nullable=True)
     last_updated_by = db.Column(db.String(MAX_LAST_UPDATED_BY_LENGTH), nullable=True)
     last_shown = db.Column(db.Date, nullable=True, index=True)
+
+class DataVersion(db.Model):
+    """Single-row counter that is bumped on every change of entries or categories."""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+class DailyEntryCount(db.Model):
+    """Number of entries per category and day, kept up to date on every write for the Grafana time series.
+
+    Purged entries are still counted, so that long-term trends stay visible.
+    """
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    cancelled_count = db.Column(db.Integer, nullable=False, default=0)
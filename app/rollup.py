@@ -0,0 +1,108 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from sqlalchemy import event, func, inspect, select, case, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from .models import Entry, DailyEntryCount
+
+KEEP_HISTORY = 'daily_counts_keep_history'  # Session info flag: removed or moved entries stay counted at their old day
+
+@contextmanager
+def keeping_daily_history(session):
+    """Keeps removed or moved entries counted at their old day for the flushes within the block."""
+    session.info[KEEP_HISTORY] = True
+    try:
+        yield
+    finally:
+        session.info.pop(KEEP_HISTORY, None)
+
+def load_previous_value(target, value, oldvalue, initiator):
+    """Does nothing, it is registered with active_history for its side effect."""
+
+# Setting an expired attribute, e.g. after a commit, would not record the day the entry was counted on otherwise
+for tracked_attribute in (Entry.category_id, Entry.date, Entry.cancelled):
+    event.listen(tracked_attribute, 'set', load_previous_value, active_history=True)
+
+def committed_value(entry, attribute):
+    """Returns the value an attribute of an entry had when it was loaded."""
+    history = inspect(entry).attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+    return history.unchanged[0] if history.unchanged else getattr(entry, attribute)
+
+def daily_count_deltas(rows):
+    """Returns the (count, cancelled_count) deltas keyed by (category_id, day) for new entries given as column dicts."""
+    deltas = defaultdict(lambda: [0, 0])
+    for row in rows:
+        delta = deltas[(row['category_id'], row['date'])]
+        delta[0] += 1
+        delta[1] += 1 if row['cancelled'] else 0
+    return {key: tuple(delta) for key, delta in deltas.items()}
+
+def adjust_daily_counts(connection, deltas):
+    """Adds (count, cancelled_count) deltas keyed by (category_id, day) to the daily counts.
+
+    Uses a single INSERT ... ON CONFLICT DO UPDATE executed for all keys.
+    """
+    rows = [{'category_id': category_id, 'day': day, 'count': count, 'cancelled_count': cancelled}
+            for (category_id, day), (count, cancelled) in deltas.items() if count or cancelled]
+    if not rows:
+        return
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(DailyEntryCount)
+    statement = statement.on_conflict_do_update(
+        index_elements=[DailyEntryCount.category_id, DailyEntryCount.day],
+        set_={
+            'count': DailyEntryCount.count + statement.excluded['count'],
+            'cancelled_count': DailyEntryCount.cancelled_count + statement.excluded['cancelled_count'],
+        }
+    )
+    connection.execute(statement, rows)
+
+def rebuild_daily_counts(session):
+    """Recounts all days from the current entries, dropping the counts of purged entries."""
+    session.execute(delete(DailyEntryCount))
+    session.execute(DailyEntryCount.__table__.insert().from_select(
+        ['category_id', 'day', 'count', 'cancelled_count'],
+        select(Entry.category_id, Entry.date, func.count(Entry.id),
+               func.sum(case((Entry.cancelled, 1), else_=0)))
+        .group_by(Entry.category_id, Entry.date)
+    ))
+
+@event.listens_for(Session, 'after_flush')
+def track_daily_counts(session, flush_context):
+    """Updates the daily counts for the entries added, changed or deleted by a flush.
+
+    Runs after the flush, when categories added in the same flush have their ids and their rows
+    exist, while the session still lists the flushed entries with their previous values.
+    """
+    keep_history = session.info.get(KEEP_HISTORY, False)
+    deltas = defaultdict(lambda: [0, 0])
+
+    def add(category_id, day, cancelled, sign):
+        delta = deltas[(category_id, day)]
+        delta[0] += sign
+        delta[1] += sign if cancelled else 0
+
+    for entry in session.new:
+        if isinstance(entry, Entry):
+            add(entry.category_id, entry.date, entry.cancelled, 1)
+    for entry in session.dirty:
+        if isinstance(entry, Entry) and session.is_modified(entry):
+            old = (committed_value(entry, 'category_id'), committed_value(entry, 'date'))
+            old_cancelled = committed_value(entry, 'cancelled')
+            if old == (entry.category_id, entry.date):
+                if old_cancelled != entry.cancelled:
+                    deltas[old][1] += 1 if entry.cancelled else -1
+            else:
+                if not keep_history:
+                    add(*old, old_cancelled, -1)
+                add(entry.category_id, entry.date, entry.cancelled, 1)
+    if not keep_history:
+        for entry in session.deleted:
+            if isinstance(entry, Entry):
+                add(committed_value(entry, 'category_id'), committed_value(entry, 'date'),
+                    committed_value(entry, 'cancelled'), -1)
+
+    if deltas:
+        adjust_daily_counts(session.connection(), {key: tuple(delta) for key, delta in deltas.items()})
@@ -1,11 +1,41 @@
-from flask import request, jsonify, render_template, redirect, url_for, make_response, send_from_directory, current_app, abort
+from flask import request, jsonify, render_template, redirect, url_for, make_response, send_from_directory, current_app, abort, Response, stream_with_context, g
 import requests
 from .models import Entry, Category
 from app import db
-from datetime import datetime
-from .helpers import handle_image_upload, parse_date, get_entry_data, create_zip
+from .cache import bump_data_version, current_data_version, conditional_on_data_version
+from datetime import datetime, date
+from .helpers import handle_image, is_valid_giphy_url, normalize_search_query, search_giphy, upload_revision, parse_date, move_to_year, is_known_locale, get_entry_data, get_cached_entry_data, get_entry_page, decode_cursor, create_zip, iter_json, ENTRY_FIELDS, COMPACT_ENTRY_FIELDS
 import os
+import mimetypes
 import validators
+from urllib.parse import quote
+from werkzeug.security import safe_join
+from .assets import IMMUTABLE_MAX_AGE
+from .rollup import keeping_daily_history
+from .images import schedule_image_processing, schedule_image_ingestion, resume_image_ingestion, remove_entry_image
+
+def non_negative_int(value):
+    """Converts a query parameter to an int, rejecting negative values."""
+    number = int(value)
+    if number < 0:
+        raise ValueError("Value must not be negative")
+    return number
+
+def get_window_args():
+    """Reads the optional category filter and entry window parameters from the request."""
+    return {
+        "category_filter": request.args.get('categories'),
+        "max_past_entries": request.args.get('max-past-entries', default=None, type=non_negative_int),
+        "max_future_entries": request.args.get('max-future-entries', default=None, type=non_negative_int),
+        "days_back": request.args.get('days-back', default=None, type=non_negative_int),
+        "days_ahead": request.args.get('days-ahead', default=None, type=non_negative_int),
+        "locale": get_locale_arg()
+    }
+
+def get_locale_arg():
+    """Reads the optional locale parameter, returns None if it is missing or unknown."""
+    locale = request.args.get('locale', '')[:20]
+    return locale if locale and is_known_locale(locale) else None
 
 def init_app(app, scheduler):
     @app.after_request
@@ -16,10 +46,44 @@ def init_app(app, scheduler):
         response.headers['Access-Control-Allow-Methods'] = 'GET,PUT,POST,DELETE,OPTIONS'
         return response
     
+    @app.url_defaults
+    def add_upload_revision(endpoint, values):
+        """Versions upload URLs, so that a replaced image gets a new URL."""
+        if endpoint == 'uploaded_file' and 'v' not in values:
+            revision = upload_revision(app.config['UPLOAD_FOLDER'], values.get('filename', ''))
+            if revision:
+                values['v'] = revision
+
     @app.route('/uploads/<filename>')
     def uploaded_file(filename):
-        """Send the requested file from the upload directory."""
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        """Send the requested file from the upload directory.
+
+        Requests for the current revision are cached as immutable. Depending on UPLOAD_SENDFILE_MODE
+        the bytes are sent by a fronting proxy (X-Accel-Redirect) or the web server (X-Sendfile).
+        """
+        upload_folder = app.config['UPLOAD_FOLDER']
+        mode = app.config['UPLOAD_SENDFILE_MODE']
+        if mode in ('x-accel-redirect', 'x-sendfile'):
+            # The proxy or web server sends the file and handles HEAD, Range and conditional requests
+            filepath = safe_join(upload_folder, filename)
+            if filepath is None or not os.path.isfile(filepath):
+                abort(404)
+            response = make_response('')
+            if mode == 'x-accel-redirect':
+                response.headers['X-Accel-Redirect'] = app.config['UPLOAD_ACCEL_REDIRECT_PREFIX'] + quote(filename)
+            else:
+                response.headers['X-Sendfile'] = os.path.abspath(filepath)
+            response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        else:
+            response = send_from_directory(upload_folder, filename)
+
+        revision = request.args.get('v')
+        if revision and revision == upload_revision(upload_folder, filename):
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+        return response
     
     @app.route('/favicon.ico')
     def favicon():
@@ -54,18 +118,18 @@ def init_app(app, scheduler):
             Request: GET /search_gifs
             Response: []
         """
-        query = request.args.get('q')
+        query = normalize_search_query(request.args.get('q', ''))
         if not query:
             return jsonify([])  # Return empty array if no query
-        response = requests.get(
-            'https://api.giphy.com/v1/gifs/search',
-            params={
-                'api_key': os.getenv('GIPHY_API_TOKEN'),
-                'q': query,
-                'limit': 15
-            }
-        )
-        return jsonify(response.json()['data'])
+
+        # Results are cached per normalized query for up to GIPHY_SEARCH_CACHE_TTL seconds after they were fetched,
+        # concurrent requests for the same query wait for a single Giphy request
+        try:
+            body = app.extensions['giphy_search_cache'].get_or_compute(query, 0, lambda: search_giphy(query))
+        except (requests.RequestException, ValueError, KeyError) as e:
+            current_app.logger.warning(f"Giphy search for {query!r} failed: {e}")
+            return jsonify({"error": "Giphy search failed"}), 502
+        return app.response_class(body, mimetype='application/json')
 
     @app.route('/get-giphy-url')
     def get_giphy_url():
@@ -109,7 +173,7 @@ def init_app(app, scheduler):
     @app.route('/', methods=['GET'])
     def index():
         """Display the main admin page."""
-        data = get_entry_data(db)
+        data = get_cached_entry_data(db)
         return render_template('admin/index.html', entries=data['entries'], categories=data['categories'])
 
     @app.route('/create', methods=['POST'])
@@ -134,13 +198,14 @@ def init_app(app, scheduler):
             category = db.session.query(Category).filter_by(name=category_name).first()
             if not category:
                 return jsonify({"error": "Invalid category"}), 400
-            if not parse_date(date_str):
+            entry_date = parse_date(date_str)
+            if not entry_date:
                 return jsonify({"error": "Invalid date format, must be YYYY-MM-DD"}), 400
             if request.form.get('url') and not validators.url(request.form.get('url')):
                 return jsonify({"error": "Invalid URL"}), 400
 
             new_entry = Entry(
-                date = date_str,
+                date = entry_date,
                 category_id = category.id,  # use the ID of the category
                 title = title,
                 description = request.form.get('description'),
@@ -150,11 +215,22 @@ def init_app(app, scheduler):
             db.session.add(new_entry)
             db.session.flush()  # Ensure the ID is assigned without committing the transaction
 
-            filename = handle_image_upload(new_entry.id, request.files.get('entryImage'), request.form.get('giphyUrl'), app.config['UPLOAD_FOLDER'], app.config['ALLOWED_EXTENSIONS'])
-            if filename:
+            # Giphy images are downloaded in the background, the entry shows no image until then
+            giphy_url = request.form.get('giphyUrl')
+            filename = None
+            if giphy_url:
+                new_entry.pending_image_url = giphy_url if is_valid_giphy_url(giphy_url) else None
+            else:
+                filename = handle_image(request.files.get('entryImage'), new_entry.id, app.config['UPLOAD_FOLDER'], app.config['ALLOWED_EXTENSIONS'])
                 new_entry.image_filename = filename
 
+            entry_id = new_entry.id
+            bump_data_version(db)
             db.session.commit()
+            if giphy_url and is_valid_giphy_url(giphy_url):
+                schedule_image_ingestion(entry_id, giphy_url)
+            elif filename:
+                schedule_image_processing(entry_id, filename)
             return redirect(url_for('index'))
 
         except Exception as e:
@@ -173,7 +249,8 @@ def init_app(app, scheduler):
             category = db.session.query(Category).filter_by(name=category_name).first()
             if not category:
                 return jsonify({"error": "Invalid category"}), 400
-            if not parse_date(request.form['date']):
+            entry_date = parse_date(request.form['date'])
+            if not entry_date:
                 return jsonify({"error": "Invalid date format, must be YYYY-MM-DD"}), 400
             if request.form.get('url') and not validators.url(request.form.get('url')):
                 return jsonify({"error": "Invalid URL"}), 400
@@ -181,29 +258,40 @@ def init_app(app, scheduler):
             giphy_url = request.form.get('giphyUrl')
             file = request.files.get('entryImage')
 
-            # Remove current image if applicable
+            # Remove current image if applicable, a pending download is dropped as well
             if 'remove_image' in request.form or giphy_url or file:
                 if entry.image_filename:
-                    image_path = os.path.join(app.config['UPLOAD_FOLDER'], entry.image_filename)
-                    if os.path.exists(image_path):
-                        os.remove(image_path)
+                    remove_entry_image(app.config['UPLOAD_FOLDER'], entry.image_filename, entry.image_variants)
                     entry.image_filename = None
+                    entry.image_variants = None
+                    entry.image_format = None
+                entry.pending_image_url = None
+                entry.pending_image_claimed_at = None
 
-            filename = handle_image_upload(entry.id, file, giphy_url, app.config['UPLOAD_FOLDER'], app.config['ALLOWED_EXTENSIONS'])
-            if filename:
-                entry.image_filename = filename
+            filename = None
+            if giphy_url:
+                entry.pending_image_url = giphy_url if is_valid_giphy_url(giphy_url) else None
+            else:
+                filename = handle_image(file, entry.id, app.config['UPLOAD_FOLDER'], app.config['ALLOWED_EXTENSIONS'])
+                if filename:
+                    entry.image_filename = filename
 
             # Update the entry with the new category ID and other fields
             entry.category_id = category.id
-            entry.date = request.form['date']
+            entry.date = entry_date
             entry.title = request.form['title']
             entry.description = request.form.get('description')
             entry.url = request.form.get('url')
             entry.last_updated_by = request.remote_addr
+            bump_data_version(db)
             db.session.commit()
+            if giphy_url and is_valid_giphy_url(giphy_url):
+                schedule_image_ingestion(id, giphy_url)
+            elif filename:
+                schedule_image_processing(id, filename)
             return redirect(url_for('index'))
 
-        return render_template('admin/update.html', entry=entry, categories=get_entry_data(db)['categories'])
+        return render_template('admin/update.html', entry=entry, categories=get_cached_entry_data(db)['categories'])
 
     @app.route('/delete/<int:id>', methods=['POST'])
     def delete(id):
@@ -212,10 +300,9 @@ def init_app(app, scheduler):
         if entry is None:
             abort(404)
         if entry.image_filename:
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], entry.image_filename)
-            if os.path.exists(image_path):
-                os.remove(image_path)
+            remove_entry_image(app.config['UPLOAD_FOLDER'], entry.image_filename, entry.image_variants)
         db.session.delete(entry)
+        bump_data_version(db)
         db.session.commit()
         return redirect(url_for('index'))
     
@@ -229,6 +316,7 @@ def init_app(app, scheduler):
     
             # Toggle the cancelled state
             entry.cancelled = not entry.cancelled
+            bump_data_version(db)
             db.session.commit()
     
             return redirect(url_for('index'))
@@ -237,6 +325,7 @@ def init_app(app, scheduler):
             return jsonify({"error": "Failed to update entry"}), 500
 
     @app.route('/timeline', methods=['GET'])
+    @conditional_on_data_version
     def timeline():
         """Generate a timeline view of entries, calculating positions based on dates.
         
@@ -246,30 +335,97 @@ def init_app(app, scheduler):
           - font-scale: Scale factor for font sizes.
           - categories: Comma-separated list of category names to filter entries.
           - max-past-entries: Maximum number of past entries to include.
+          - max-future-entries: Maximum number of upcoming entries to include.
+          - days-back: Only include past entries from at most this many days ago.
+          - days-ahead: Only include upcoming entries at most this many days ahead.
+          - locale: Locale for the formatted dates, e.g. en_US (defaults to TIMELINE_LOCALE).
         """
         timeline_height = request.args.get('timeline-height', default='calc(50vh - 20px)')[:25]
         font_family = request.args.get('font-family', default='sans-serif')[:35]
         font_scale = request.args.get('font-scale', default='1')[:5]
-        category_filter = request.args.get('categories')
-        max_past_entries = request.args.get('max-past-entries', default=None, type=int)
-        
-        data = get_entry_data(db, category_filter, max_past_entries)
-        display_celebration = any(entry.get('is_today') and entry.get('category').get('display_celebration')
-                                   for entry in data.get('entries'))
-        
-        return make_response(render_template('timeline/timeline.html', 
-                                             entries=data.get('entries'), 
-                                             categories=data.get('categories'),
-                                             display_celebration=display_celebration,
-                                             timeline_height=timeline_height, 
-                                             font_family=font_family, 
-                                             font_scale=font_scale))
+        window_args = get_window_args()
+
+        def render_timeline():
+            data = get_cached_entry_data(db, **window_args)
+            display_celebration = any(entry.get('is_today') and entry.get('category').get('display_celebration')
+                                       for entry in data.get('entries'))
+            return render_template('timeline/timeline.html', 
+                                   entries=data.get('entries'), 
+                                   categories=data.get('categories'),
+                                   display_celebration=display_celebration,
+                                   timeline_height=timeline_height, 
+                                   font_family=font_family, 
+                                   font_scale=font_scale)
+
+        # The rendered page is cached per parameter set until the data changes or the day rolls over.
+        # While one request renders the new version, concurrent requests get the previous one.
+        key = (timeline_height, font_family, font_scale, tuple(sorted(window_args.items())))
+        version = (current_data_version(db), date.today())
+        html, g.stale_response = app.extensions['timeline_cache'].get_or_compute_stale(key, version, render_timeline)
+        return make_response(html)
     
     @app.route('/api/data', methods=['GET'])
+    @conditional_on_data_version
     def api_data():
-        """Return a JSON response with data for all data, including image URLs.""" 
-        return jsonify(get_entry_data(db))
+        """Return a JSON response with data for all data, including image URLs.
+        
+        Accepts the same categories, max-past-entries, max-future-entries, days-back,
+        days-ahead and locale query parameters as the timeline. With stream=true the entries are
+        encoded row by row while they are read from the database instead of all at once.
+
+        With format=compact entries reference their category by category_id instead of
+        embedding it, and fields selects a comma-separated subset of the entry attributes
+        of the chosen format.
+        """
+        compact = request.args.get('format') == 'compact'
+        available_fields = COMPACT_ENTRY_FIELDS if compact else ENTRY_FIELDS
+        fields = tuple(field.strip() for field in request.args.get('fields', '').split(',') if field.strip())
+        unknown_fields = [field for field in fields if field not in available_fields]
+        if unknown_fields:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown_fields)}", "fields": available_fields}), 400
+        format_args = {"compact": compact, "fields": fields or None}
+
+        if request.args.get('stream') == 'true':
+            data = get_entry_data(db, stream=True, **format_args, **get_window_args())
+            return Response(stream_with_context(iter_json(data)), mimetype='application/json')
+        return jsonify(get_cached_entry_data(db, **format_args, **get_window_args()))
+
+    @app.route('/api/entries', methods=['GET'])
+    @conditional_on_data_version
+    def api_entries():
+        """Return one page of entries ordered by date, using keyset pagination.
+        
+        Accepts the following query parameters:
+          - from: Only include entries on or after this date (YYYY-MM-DD).
+          - to: Only include entries on or before this date (YYYY-MM-DD).
+          - categories: Comma-separated list of category names to filter entries.
+          - limit: Maximum number of entries per page (capped by API_ENTRIES_MAX_LIMIT).
+          - cursor: The next_cursor value of the previous page.
+        """
+        date_from = date_to = cursor = None
+        if request.args.get('from'):
+            date_from = parse_date(request.args['from'])
+            if not date_from:
+                return jsonify({"error": "Invalid from date, must be YYYY-MM-DD"}), 400
+        if request.args.get('to'):
+            date_to = parse_date(request.args['to'])
+            if not date_to:
+                return jsonify({"error": "Invalid to date, must be YYYY-MM-DD"}), 400
+        if request.args.get('cursor'):
+            cursor = decode_cursor(request.args['cursor'])
+            if not cursor:
+                return jsonify({"error": "Invalid cursor"}), 400
+        limit = request.args.get('limit', default=app.config['API_ENTRIES_DEFAULT_LIMIT'], type=int)
+        limit = max(1, min(limit, app.config['API_ENTRIES_MAX_LIMIT']))
+
+        return jsonify(get_entry_page(db, date_from, date_to, request.args.get('categories'), limit, cursor))
     
+    @scheduler.task('interval', id='resume_image_ingestion', minutes=app.config['IMAGE_INGEST_RESUME_INTERVAL'])
+    def resume_pending_image_ingestion():
+        """Picks up pending Giphy downloads whose worker stopped before finishing them."""
+        with scheduler.app.app_context():
+            resume_image_ingestion()
+
     @scheduler.task('cron', id='update_serial_entries', month=1, day=1, hour=3, minute=0)
     @app.route('/update-serial-entries', methods=['POST'])
     def update_serial_entries():
@@ -280,9 +436,12 @@ def init_app(app, scheduler):
             category_ids = [category.id for category in serial_categories]
         
             serial_entries = db.session.query(Entry).filter(Entry.category_id.in_(category_ids)).all()
-            for entry in serial_entries:
-                entry.date = f"{current_year}-{entry.date.split('-')[1]}-{entry.date.split('-')[2]}"
-            db.session.commit()
+            # Last year's occurrences stay counted in the daily counts
+            with keeping_daily_history(db.session):
+                for entry in serial_entries:
+                    entry.date = move_to_year(entry.date, current_year)
+                bump_data_version(db)
+                db.session.commit()
             scheduler.app.logger.info("All serial entries have been updated to the current year")
             return jsonify({"message": "All serial entries have been updated to the current year"}), 200
 
@@ -300,14 +459,15 @@ def init_app(app, scheduler):
             # 2. Have dates in the past
             old_entries = db.session.query(Entry).filter(
                 Entry.category_id.in_(category_ids),
-                Entry.date < str(current_date)
+                Entry.date < current_date
             ).all()
-            for entry in old_entries:
-                if entry.image_filename:
-                    image_path = os.path.join(app.config['UPLOAD_FOLDER'], entry.image_filename)
-                    if os.path.exists(image_path):
-                        os.remove(image_path)
-                db.session.delete(entry)
-            db.session.commit()
+            # Purged entries stay counted in the daily counts
+            with keeping_daily_history(db.session):
+                for entry in old_entries:
+                    if entry.image_filename:
+                        remove_entry_image(app.config['UPLOAD_FOLDER'], entry.image_filename, entry.image_variants)
+                    db.session.delete(entry)
+                bump_data_version(db)
+                db.session.commit()
             scheduler.app.logger.info("Old entries have been purged")
             return jsonify({"message": "Old entries have been purged"}), 200
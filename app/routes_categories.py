@@ -1,6 +1,8 @@
 from flask import request, jsonify, render_template, redirect, url_for
-from .models import Category, Entry
+from .models import Category, Entry, DailyEntryCount
 from app import db
+from .cache import bump_data_version
+from .helpers import adjust_lightness
 
 def init_categories_routes(app):
     @app.route('/categories', methods=['GET', 'POST'])
@@ -16,11 +18,12 @@ def init_categories_routes(app):
             last_updated_by = request.remote_addr
 
             new_category = Category(
-                name=name, symbol=symbol, color_hex=color_hex,
+                name=name, symbol=symbol, color_hex=color_hex, color_hex_variation=adjust_lightness(color_hex),
                 repeat_annually=repeat_annually, display_celebration=display_celebration,
                 is_protected=is_protected, last_updated_by=last_updated_by
             )
             db.session.add(new_category)
+            bump_data_version(db)
             db.session.commit()
             return redirect(url_for('categories'))
 
@@ -34,10 +37,12 @@ def init_categories_routes(app):
             category.name = request.form.get('name', category.name)
             category.symbol = request.form.get('symbol', category.symbol)
             category.color_hex = request.form.get('color_hex', category.color_hex)
+            category.color_hex_variation = adjust_lightness(category.color_hex)
             category.repeat_annually = bool(request.form.get('repeat_annually'))
             category.display_celebration = bool(request.form.get('display_celebration'))
             category.is_protected = bool(request.form.get('is_protected'))
             category.last_updated_by = request.remote_addr
+            bump_data_version(db)
             db.session.commit()
             return redirect(url_for('categories'))
         return jsonify({"error": "Category not found"}), 404
@@ -48,7 +53,9 @@ def init_categories_routes(app):
         if category:
             if db.session.query(Entry).filter_by(category_id=id).first():
                 return jsonify({"error": "Cannot delete category because it has associated entries"}), 400
+            db.session.query(DailyEntryCount).filter_by(category_id=id).delete()
             db.session.delete(category)
+            bump_data_version(db)
             db.session.commit()
             return redirect(url_for('categories'))
         return jsonify({"error": "Category not found"}), 404 
\ No newline at end of file
@@ -1,8 +1,113 @@
+import calendar
+import json
+import re
+from datetime import date, datetime, time, timedelta
+from functools import wraps
+from hashlib import sha1
+from math import ceil
 from flask import request, jsonify, current_app
-from datetime import datetime
-from .models import Entry, Category
+from sqlalchemy import select, cast, String
+from .models import Entry, Category, DailyEntryCount
+from .helpers import date_to_millis
+from .cache import get_data_version
 from app import db
 
+HOUR_MILLIS = 60 * 60 * 1000
+DAY_MILLIS = 24 * HOUR_MILLIS
+# Request fields that change with every refresh or only matter through the days and bucket they resolve to
+VOLATILE_REQUEST_FIELDS = {'range', 'rangeRaw', 'interval', 'intervalMs', 'maxDataPoints', 'requestId', 'startTime',
+                           'panelId', 'dashboardId', 'dashboardUID', 'timezone', 'scopedVars', 'app'}
+# A year or month of an ISO date, such as 2023 or 2023-05
+DATE_PREFIX_PATTERN = re.compile(r'(\d{4})(?:-(\d{2}))?')
+
+def parse_grafana_time(value):
+    """Parses a timestamp of a Grafana range such as '2023-01-01T00:00:00.000Z', None if it is missing or invalid."""
+    if isinstance(value, str) and value.endswith('Z'):
+        value = value[:-1] + '+00:00'  # fromisoformat only accepts the Z suffix since Python 3.11
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+def grafana_date_range(req):
+    """Returns the first and last date whose local midnight lies within the range of a Grafana request, None for open ends."""
+    time_range = req.get('range') or {}
+    start, end = parse_grafana_time(time_range.get('from')), parse_grafana_time(time_range.get('to'))
+    first_day = last_day = None
+    if start:
+        start = start.astimezone()
+        first_day = start.date() if start.time() == time.min else start.date() + timedelta(days=1)
+    if end:
+        last_day = end.astimezone().date()
+    return first_day, last_day
+
+def grafana_bucket_millis(req):
+    """Returns the bucket size in milliseconds that a Grafana request asks for, None if days are fine enough."""
+    interval = req.get('intervalMs') or 0
+    time_range = req.get('range') or {}
+    start, end = parse_grafana_time(time_range.get('from')), parse_grafana_time(time_range.get('to'))
+    if req.get('maxDataPoints') and start and end:
+        # Rounded up to whole hours, so that the bucket stays the same while a refreshing range moves along
+        interval = max(interval, ceil((end - start).total_seconds() * 1000 / req['maxDataPoints'] / HOUR_MILLIS) * HOUR_MILLIS)
+    return int(interval) if interval > DAY_MILLIS else None
+
+def downsample(datapoints, bucket):
+    """Sums [count, millis] datapoints, ordered by time, into buckets aligned to multiples of bucket milliseconds."""
+    buckets = []
+    for count, millis in datapoints:
+        start = millis - millis % bucket
+        if buckets and buckets[-1][1] == start:
+            buckets[-1][0] += count
+        else:
+            buckets.append([count, start])
+    return buckets
+
+def date_prefix_range(prefix):
+    """Returns the first and last date of a year (YYYY) or month (YYYY-MM), None for any other text."""
+    match = DATE_PREFIX_PATTERN.fullmatch(prefix)
+    if not match:
+        return None
+    year, month = int(match[1]), int(match[2]) if match[2] else None
+    if year < 1 or (month is not None and not 1 <= month <= 12):
+        return None
+    if month is None:
+        return date(year, 1, 1), date(year, 12, 31)
+    return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+
+def grafana_cache_key(endpoint, req):
+    """Returns the cache key of a Grafana request, a hash of its canonical JSON body.
+
+    The range and interval are replaced by the days and bucket they resolve to, so refreshes of
+    a dashboard whose range moves by a few seconds share the key.
+    """
+    req = req if isinstance(req, dict) else {}
+    canonical = {name: value for name, value in req.items() if name not in VOLATILE_REQUEST_FIELDS}
+    canonical['days'] = [day.isoformat() if day else None for day in grafana_date_range(req)]
+    canonical['bucket'] = grafana_bucket_millis(req)
+    body = json.dumps(canonical, sort_keys=True, separators=(',', ':'), default=str)
+    return f"{endpoint}:{sha1(body.encode()).hexdigest()}"
+
+def cached_grafana_response(view):
+    """Answers repeated Grafana requests from the grafana_cache until the data version changes.
+
+    Concurrent identical requests wait for a single computation. Errors and responses larger than
+    GRAFANA_CACHE_MAX_RESPONSE_SIZE are not kept.
+    """
+    @wraps(view)
+    def wrapper():
+        cache = current_app.extensions['grafana_cache']
+        key = grafana_cache_key(request.endpoint, request.get_json(silent=True))
+
+        def render():
+            response = current_app.make_response(view())
+            return response.status_code, response.mimetype, response.get_data()
+
+        status, mimetype, body = cache.get_or_compute(key, get_data_version(db), render)
+        if status != 200 or len(body) > current_app.config['GRAFANA_CACHE_MAX_RESPONSE_SIZE']:
+            cache.discard(key)
+        return current_app.response_class(body, status=status, mimetype=mimetype)
+    return wrapper
+
 def init_grafana_routes(app):
     """
     Initialize Grafana routes for the Flask application.
@@ -20,6 +125,7 @@ def init_grafana_routes(app):
         return "Connection established", 200
 
     @app.route('/grafana/search', methods=['POST'])
+    @cached_grafana_response
     def grafana_search():
         """
         Endpoint for Grafana to search available targets based on dynamic categories.
@@ -33,60 +139,90 @@ def init_grafana_routes(app):
             return jsonify({"error": "Search failed"}), 500
 
     @app.route('/grafana/query', methods=['POST'])
+    @cached_grafana_response
     def grafana_query():
         """
         Endpoint for Grafana to query data dynamically based on category names.
+
+        All targets are read from the daily entry counts in a single query restricted to the requested range,
+        so the work grows with the days in the range, not with the entries. Purged entries stay counted.
+        If intervalMs or maxDataPoints call for coarser points than days, the counts are summed
+        into buckets aligned to multiples of the interval.
         """
         req = request.get_json()
         try:
+            names = [target['target'] for target in req['targets'] if target.get('type') == 'timeserie']
+            first_day, last_day = grafana_date_range(req)
+            join_condition = (DailyEntryCount.category_id == Category.id) & (DailyEntryCount.count > 0)
+            if first_day:
+                join_condition &= DailyEntryCount.day >= first_day
+            if last_day:
+                join_condition &= DailyEntryCount.day <= last_day
+
+            # The outer join keeps categories without entries in the range, they get an empty series
+            rows = db.session.execute(
+                select(Category.name, DailyEntryCount.day, DailyEntryCount.count)
+                .outerjoin(DailyEntryCount, join_condition)
+                .where(Category.name.in_(names))
+                .order_by(Category.id, DailyEntryCount.day)
+            ).all()
+            series = {}
+            for name, day, count in rows:
+                datapoints = series.setdefault(name, [])
+                if day is not None:
+                    datapoints.append([count, date_to_millis(day)])
+
+            bucket = grafana_bucket_millis(req)
             response = []
-            for target in req['targets']:
-                category = db.session.query(Category).filter_by(name=target['target']).first()
-                if category and target['type'] == 'timeserie':
-                    data_points = db.session.query(
-                        Entry.date, 
-                        db.func.count(Entry.id).label('count')
-                    ).filter(Entry.category_id == category.id).group_by(Entry.date).all()
-    
-                    datapoints = [
-                        [count, datetime.strptime(date, '%Y-%m-%d').timestamp() * 1000]
-                        for date, count in data_points
-                    ]
-    
+            for name in names:
+                if name in series:
+                    datapoints = series[name]
                     response.append({
-                        "target": target['target'],
-                        "datapoints": datapoints
+                        "target": name,
+                        "datapoints": downsample(datapoints, bucket) if bucket else datapoints
                     })
-    
             return jsonify(response)
         except Exception as e:
             current_app.logger.error(f"Query failed: {e}")
             return jsonify({"error": "Query failed"}), 500
 
     @app.route('/grafana/annotations', methods=['POST'])
+    @cached_grafana_response
     def grafana_annotations():
         """
         Endpoint for Grafana to fetch annotations based on multiple category names.
+
+        Only entries within the requested range are returned, the most recent ones up to
+        GRAFANA_ANNOTATIONS_LIMIT or the smaller limit of the annotation query.
         """
         req = request.get_json()
         try:
-            annotations = []
             query_categories = req['annotation']['query'].split(',')  # Split the query by commas
             query_categories = [name.strip() for name in query_categories]  # Clean whitespace
-    
-            categories = db.session.query(Category).filter(Category.name.in_(query_categories)).all()
-            category_ids = [cat.id for cat in categories]  # List of category IDs from the query
-    
-            if category_ids:
-                entries = db.session.query(Entry).filter(Entry.category_id.in_(category_ids)).all()
-                for entry in entries:
-                    annotations.append({
-                        "annotation": req['annotation'],
-                        "time": datetime.strptime(entry.date, '%Y-%m-%d').timestamp() * 1000,
-                        "title": entry.title,
-                        "tags": [entry.category.name],
-                        "text": entry.description or ""
-                    })
+
+            limit = app.config['GRAFANA_ANNOTATIONS_LIMIT']
+            if isinstance(req['annotation'].get('limit'), int) and req['annotation']['limit'] > 0:
+                limit = min(limit, req['annotation']['limit'])
+
+            query = (
+                select(Entry.date, Entry.title, Entry.description, Category.name)
+                .join(Category, Entry.category_id == Category.id)
+                .where(Category.name.in_(query_categories))
+            )
+            first_day, last_day = grafana_date_range(req)
+            if first_day:
+                query = query.where(Entry.date >= first_day)
+            if last_day:
+                query = query.where(Entry.date <= last_day)
+            rows = db.session.execute(query.order_by(Entry.date.desc(), Entry.id.desc()).limit(limit)).all()
+
+            annotations = [{
+                "annotation": req['annotation'],
+                "time": date_to_millis(day),
+                "title": title,
+                "tags": [category_name],
+                "text": description or ""
+            } for day, title, description, category_name in reversed(rows)]
             return jsonify(annotations)
         except Exception as e:
             current_app.logger.error(f"Annotations failed: {e}")
@@ -105,19 +241,44 @@ def init_grafana_routes(app):
         ])
 
     @app.route('/grafana/tag-values', methods=['POST'])
+    @cached_grafana_response
     def grafana_tag_values():
         """
         Endpoint for Grafana to fetch tag values based on key dynamically.
+
+        An optional query filters the values. For dates, a year or month such as 2023-05 is looked up
+        as a range of the date index, any other text such as 05-20 is matched anywhere in the date.
+        Dates are restricted to the requested range, and the most recent ones are returned, at most
+        GRAFANA_TAG_VALUES_LIMIT or the smaller limit of the request.
         """
         req = request.get_json()
         key = req['key']
+        search = str(req.get('query') or '').strip()
+        limit = app.config['GRAFANA_TAG_VALUES_LIMIT']
+        if isinstance(req.get('limit'), int) and req['limit'] > 0:
+            limit = min(limit, req['limit'])
         try:
             if key == "category":
-                categories = db.session.query(Category.name).distinct().all()
-                values = [{"text": category.name} for category in categories]
+                query = select(Category.name).order_by(Category.name).limit(limit)
+                if search:
+                    query = query.where(Category.name.icontains(search, autoescape=True))
+                values = [{"text": name} for name in db.session.scalars(query)]
             elif key == "date":
-                dates = db.session.query(Entry.date).distinct().all()
-                values = [{"text": date[0]} for date in dates]
+                query = select(Entry.date).distinct()
+                first_day, last_day = grafana_date_range(req)
+                if search:
+                    prefix_range = date_prefix_range(search)
+                    if prefix_range:
+                        first_day = max(first_day, prefix_range[0]) if first_day else prefix_range[0]
+                        last_day = min(last_day, prefix_range[1]) if last_day else prefix_range[1]
+                    else:
+                        query = query.where(cast(Entry.date, String).contains(search, autoescape=True))
+                if first_day:
+                    query = query.where(Entry.date >= first_day)
+                if last_day:
+                    query = query.where(Entry.date <= last_day)
+                dates = db.session.scalars(query.order_by(Entry.date.desc()).limit(limit)).all()
+                values = [{"text": day.isoformat()} for day in reversed(dates)]
             else:
                 values = []
             return jsonify(values)
@@ -125,9 +286,19 @@ def init_grafana_routes(app):
             current_app.logger.error(f"Failed to fetch tag values: {e}")
             return jsonify({"error": "Failed to fetch tag values"}), 500
 
+    @app.route('/grafana/cache-stats')
+    def grafana_cache_stats():
+        """
+        Endpoint to monitor the Grafana response cache of this worker.
+
+        :return: JSON object with the number of cached responses, the maximum and the hits and misses
+        """
+        return jsonify(app.extensions['grafana_cache'].stats())
+
     app.add_url_rule('/grafana/', view_func=grafana_test_connection)
     app.add_url_rule('/grafana/search', view_func=grafana_search, methods=['POST'])
     app.add_url_rule('/grafana/query', view_func=grafana_query, methods=['POST'])
     app.add_url_rule('/grafana/annotations', view_func=grafana_annotations, methods=['POST'])
     app.add_url_rule('/grafana/tag-keys', view_func=grafana_tag_keys, methods=['POST'])
-    app.add_url_rule('/grafana/tag-values', view_func=grafana_tag_values, methods=['POST'])
\ No newline at end of file
+    app.add_url_rule('/grafana/tag-values', view_func=grafana_tag_values, methods=['POST'])
+    app.add_url_rule('/grafana/cache-stats', view_func=grafana_cache_stats)
\ No newline at end of file
@@ -1,90 +1,170 @@
+import click
 from flask import current_app, request, jsonify, send_file, make_response
+from sqlalchemy import select, insert
 from .models import Entry, Category, Quote
-from .helpers import get_entry_data, create_zip, get_entry_data
+from .helpers import get_entry_data, create_zip, parse_date, adjust_lightness, STREAM_BATCH_SIZE
 from os import path
 from app import db 
+from .cache import bump_data_version
+from .rollup import rebuild_daily_counts, adjust_daily_counts, daily_count_deltas
+
+def format_export_quote(quote):
+    return {
+        "id": quote.id,
+        "text": quote.text,
+        "author": quote.author,
+        "category": quote.category,
+        "url": quote.url,
+        "last_updated_by": quote.last_updated_by,
+        "last_shown": quote.last_shown.isoformat() if quote.last_shown else None
+    }
+
+def chunked(items, size):
+    """Yields consecutive slices of a list with at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def import_categories(categories_data, remote_addr):
+    """Creates or updates the imported categories, looking up the existing ones in a single query."""
+    names = [category_data['name'] for category_data in categories_data]
+    existing = {category.name: category for category in Category.query.filter(Category.name.in_(names))}
+    for category_data in categories_data:
+        category = existing.get(category_data['name'])
+        if not category:
+            category = existing[category_data['name']] = Category(
+                name=category_data['name'],
+                symbol=category_data.get('symbol', ''),
+                color_hex=category_data.get('color_hex', '#FFFFFF'),
+                repeat_annually=category_data.get('repeat_annually', False),
+                display_celebration=category_data.get('display_celebration', False),
+                is_protected=category_data.get('is_protected', False),
+                last_updated_by=category_data.get('last_updated_by', remote_addr)
+            )
+            db.session.add(category)
+        else:
+            category.symbol = category_data.get('symbol', category.symbol)
+            category.color_hex = category_data.get('color_hex', category.color_hex)
+            category.repeat_annually = category_data.get('repeat_annually', category.repeat_annually)
+            category.display_celebration = category_data.get('display_celebration', category.display_celebration)
+            category.is_protected = category_data.get('is_protected', category.is_protected)
+            category.last_updated_by = category_data.get('last_updated_by', remote_addr)
+        category.color_hex_variation = adjust_lightness(category.color_hex)
+
+def build_entry_rows(entries_data, remote_addr):
+    """Validates the imported entries and returns them as column dicts for a bulk insert.
+
+    Categories are resolved from a map of all category names loaded once. Returns the rows and
+    an error message, which is None if all entries are valid.
+    """
+    category_ids = dict(db.session.execute(select(Category.name, Category.id)).all())
+    rows = []
+    for entry_data in entries_data:
+        category_id = category_ids.get(entry_data.get('category').get('name'))
+        if category_id is None:
+            return None, f"Category '{entry_data.get('category')}' not found"
+        entry_date = parse_date(entry_data['date'])
+        if not entry_date:
+            return None, f"Invalid date '{entry_data['date']}', must be YYYY-MM-DD"
+        rows.append({
+            'date': entry_date,
+            'category_id': category_id,
+            'title': entry_data['title'],
+            'description': entry_data.get('description', None),
+            'url': entry_data.get('url', None),
+            'cancelled': entry_data.get('cancelled', False),
+            'last_updated_by': entry_data.get('last_updated_by', remote_addr)
+        })
+    return rows, None
+
+def build_quote_rows(quotes_data, remote_addr):
+    """Returns the imported quotes that do not exist yet as column dicts, skipping duplicates of text and author.
+
+    The keys of the existing quotes are loaded once.
+    """
+    keys = {tuple(row) for row in db.session.execute(select(Quote.text, Quote.author))}
+    rows = []
+    for quote_data in quotes_data:
+        key = (quote_data['text'], quote_data['author'])
+        if key in keys:
+            continue
+        keys.add(key)
+        rows.append({
+            'text': quote_data['text'],
+            'author': quote_data['author'],
+            'category': quote_data.get('category', None),
+            'url': quote_data.get('url', None),
+            'last_updated_by': quote_data.get('last_updated_by', remote_addr)
+        })
+    return rows
+
+def insert_entry_rows(rows, chunk_size):
+    """Bulk inserts entries in chunks of chunk_size, each committed with its daily counts and a data version bump.
+
+    The bulk insert bypasses the session's flush, so the daily counts are adjusted here.
+    """
+    for chunk in chunked(rows, chunk_size):
+        db.session.execute(insert(Entry), chunk)
+        adjust_daily_counts(db.session.connection(), daily_count_deltas(chunk))
+        bump_data_version(db)
+        db.session.commit()
+
+def insert_quote_rows(rows, chunk_size):
+    """Bulk inserts quotes in chunks of chunk_size, committing each chunk."""
+    for chunk in chunked(rows, chunk_size):
+        db.session.execute(insert(Quote), chunk)
+        db.session.commit()
 
 def init_maintenance_routes(app):
 
+    @app.cli.command('rebuild-daily-counts')
+    def rebuild_daily_counts_command():
+        """Recounts the daily entry counts for Grafana from the current entries.
+
+        Counts of purged entries are lost, only use it to repair the counts after changes to the database outside the app.
+        """
+        rebuild_daily_counts(db.session)
+        bump_data_version(db)
+        db.session.commit()
+        click.echo("Daily entry counts have been rebuilt")
+
     @app.route('/batch-import', methods=['POST'])
     def batch_import():
+        """Imports categories, entries and quotes.
+
+        Lookups are loaded once and entries and quotes are bulk inserted in chunks of
+        BATCH_IMPORT_CHUNK_SIZE, each committed on its own. All entries are validated
+        before anything is written.
+        """
         data = request.get_json()
         if not data:
             return jsonify({"error": "No data provided"}), 400
 
         # Kategorien importieren
-        if 'categories' in data:
-            for category_data in data['categories']:
-                category = Category.query.filter_by(name=category_data['name']).first()
-                if not category:
-                    category = Category(
-                        name=category_data['name'],
-                        symbol=category_data.get('symbol', ''),
-                        color_hex=category_data.get('color_hex', '#FFFFFF'),
-                        repeat_annually=category_data.get('repeat_annually', False),
-                        display_celebration=category_data.get('display_celebration', False),
-                        is_protected=category_data.get('is_protected', False),
-                        last_updated_by=category_data.get('last_updated_by', request.remote_addr)
-                    )
-                    db.session.add(category)
-                else:
-                    category.symbol = category_data.get('symbol', category.symbol)
-                    category.color_hex = category_data.get('color_hex', category.color_hex)
-                    category.repeat_annually = category_data.get('repeat_annually', category.repeat_annually)
-                    category.display_celebration = category_data.get('display_celebration', category.display_celebration)
-                    category.is_protected = category_data.get('is_protected', category.is_protected)
-                    category.last_updated_by = category_data.get('last_updated_by', request.remote_addr)
-
+        import_categories(data.get('categories', []), request.remote_addr)
         db.session.flush()
 
-        # Kalendereinträge importieren
-        if 'entries' in data:
-            for entry_data in data['entries']:
-                category = Category.query.filter_by(name=entry_data.get('category').get('name')).first()
-                if not category:
-                    return jsonify({"error": f"Category '{entry_data.get('category')}' not found"}), 400
-                new_entry = Entry(
-                    date=entry_data['date'],
-                    category_id=category.id,
-                    title=entry_data['title'],
-                    description=entry_data.get('description', None),
-                    url=entry_data.get('url', None),
-                    cancelled=entry_data.get('cancelled', False),
-                    last_updated_by=entry_data.get('last_updated_by', request.remote_addr)
-                )
-                db.session.add(new_entry)
-        
-        # Zitate importieren
-        if 'quotes' in data:
-            for quote_data in data['quotes']:
-                existing = Quote.query.filter_by(text=quote_data['text'], author=quote_data['author']).first()
-                if not existing:
-                    new_quote = Quote(
-                        text=quote_data['text'],
-                        author=quote_data['author'],
-                        category=quote_data.get('category', None),
-                        url=quote_data.get('url', None),
-                        last_updated_by=quote_data.get('last_updated_by', request.remote_addr)
-                    )
-                    db.session.add(new_quote)
+        # Kalendereinträge prüfen, bevor etwas gespeichert wird
+        entry_rows, error = build_entry_rows(data.get('entries', []), request.remote_addr)
+        if error:
+            db.session.rollback()
+            return jsonify({"error": error}), 400
+        quote_rows = build_quote_rows(data.get('quotes', []), request.remote_addr)
 
+        if 'categories' in data:
+            bump_data_version(db)
         db.session.commit()
-        return jsonify({"message": "Import erfolgreich"}), 201
+
+        # Kalendereinträge und Zitate blockweise importieren
+        chunk_size = app.config['BATCH_IMPORT_CHUNK_SIZE']
+        insert_entry_rows(entry_rows, chunk_size)
+        insert_quote_rows(quote_rows, chunk_size)
+        return jsonify({"message": "Import erfolgreich", "entries": len(entry_rows), "quotes": len(quote_rows)}), 201
 
     @app.route('/export-data', methods=['GET'])
     def export_data():
-        # Kombinierte Daten aus Kalender und Zitaten exportieren
-        data = get_entry_data(db)  # Enthält entries und categories
-        quotes = [{
-            "id": quote.id,
-            "text": quote.text,
-            "author": quote.author,
-            "category": quote.category,
-            "url": quote.url,
-            "last_updated_by": quote.last_updated_by,
-            "last_shown": quote.last_shown.isoformat() if quote.last_shown else None
-        } for quote in Quote.query.all()]
-        data["quotes"] = quotes
+        # Kombinierte Daten aus Kalender und Zitaten exportieren, Einträge und Zitate werden beim Schreiben gestreamt
+        data = get_entry_data(db, stream=True)  # Enthält entries und categories
+        data["quotes"] = (format_export_quote(quote) for quote in Quote.query.order_by(Quote.id).yield_per(STREAM_BATCH_SIZE))
 
         zip_buffer = create_zip(data, current_app.config['UPLOAD_FOLDER'], current_app.config['SQLALCHEMY_DATABASE_URI'])
         response = make_response(send_file(zip_buffer, mimetype='application/zip', as_attachment=True, download_name='data_export.zip'))
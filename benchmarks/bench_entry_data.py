@@ -0,0 +1,87 @@
+"""Benchmark of get_entry_data against ORM hydration of the same entries.
+
+Both paths use the same cached date formatting and the stored color variation,
+so the difference is the query and serialization, not caching.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_entry_data [number of entries ...]
+"""
+import sys
+from datetime import date, timedelta
+from time import perf_counter
+from flask import url_for
+from sqlalchemy.orm import joinedload
+from app import create_app, db
+from app.config import TestConfig
+from app.helpers import get_entry_data, format_entry_date
+from app.models import Entry, Category
+
+def orm_entry_data():
+    """The former implementation: ORM objects with joined categories, formatted one by one.
+
+    Uses the cached formatting of the projection, so only the way entries are read differs.
+    """
+    entries = db.session.query(Entry).options(joinedload(Entry.category)).order_by(Entry.date).all()
+    today = date.today()
+    return [{
+        "id": entry.id,
+        "date": entry.date.isoformat(),
+        "date_formatted": format_entry_date(entry.date, 'de_DE', 'd. MMMM'),
+        "title": entry.title,
+        "description": entry.description,
+        "category": {
+            "id": entry.category.id,
+            "name": entry.category.name,
+            "symbol": entry.category.symbol,
+            "color_hex": entry.category.color_hex,
+            "color_hex_variation": entry.category.color_hex_variation,
+            "repeat_annually": entry.category.repeat_annually,
+            "display_celebration": entry.category.display_celebration,
+            "is_protected": entry.category.is_protected,
+            "last_updated_by": entry.category.last_updated_by
+        },
+        "url": entry.url,
+        "image_url": url_for('uploaded_file', filename=entry.image_filename) if entry.image_filename else None,
+        "image_url_external": url_for('uploaded_file', filename=entry.image_filename, _external=True) if entry.image_filename else None,
+        "index": i,
+        "is_today": entry.date == today,
+        "cancelled": entry.cancelled,
+        "last_updated_by": entry.last_updated_by
+    } for i, entry in enumerate(entries)]
+
+def fill_database(count):
+    db.session.query(Entry).delete()
+    category_ids = [category.id for category in db.session.query(Category).all()]
+    first_day = date.today() - timedelta(days=count // 20)
+    db.session.execute(Entry.__table__.insert(), [{
+        "date": first_day + timedelta(days=i // 10),
+        "category_id": category_ids[i % len(category_ids)],
+        "title": f"Entry {i}",
+        "description": "Benchmark entry",
+        "image_filename": f"{i}.gif" if i % 3 == 0 else None,
+        "cancelled": False
+    } for i in range(count)])
+    db.session.commit()
+
+def best_of(function, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+def main(counts):
+    app = create_app(TestConfig)
+    with app.test_request_context():
+        db.create_all()
+        for count in counts:
+            fill_database(count)
+            orm = best_of(orm_entry_data)
+            projected = best_of(lambda: get_entry_data(db))
+            print(f"{count:>7} entries: ORM {orm * 1000:8.1f} ms, projection {projected * 1000:8.1f} ms, speedup {orm / projected:4.1f}x")
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [10_000, 100_000])
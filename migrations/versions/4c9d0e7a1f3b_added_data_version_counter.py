@@ -0,0 +1,30 @@
+"""Added data version counter
+
+Revision ID: 4c9d0e7a1f3b
+Revises: b7e2f41c9a0d
+Create Date: 2026-10-17 11:03:48.217530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c9d0e7a1f3b'
+down_revision = 'b7e2f41c9a0d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    data_version_table = op.create_table('data_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(data_version_table, [{'id': 1, 'version': 0, 'updated_at': None}])
+
+
+def downgrade():
+    op.drop_table('data_version')
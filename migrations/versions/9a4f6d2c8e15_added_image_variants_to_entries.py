@@ -0,0 +1,26 @@
+"""Added image variants to entries
+
+Revision ID: 9a4f6d2c8e15
+Revises: e5a8c3b2d71f
+Create Date: 2026-10-17 14:05:47.218903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4f6d2c8e15'
+down_revision = 'e5a8c3b2d71f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('image_variants', sa.String(length=400), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.drop_column('image_variants')
@@ -0,0 +1,38 @@
+"""Added daily entry counts for Grafana
+
+Revision ID: a6c2e9f3b7d4
+Revises: f1b8a6e4c2d0
+Create Date: 2026-10-17 17:40:12.085331
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c2e9f3b7d4'
+down_revision = 'f1b8a6e4c2d0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_entry_count',
+    sa.Column('category_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('cancelled_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['category_id'], ['category.id'], ),
+    sa.PrimaryKeyConstraint('category_id', 'day')
+    )
+
+    # Counts the existing entries
+    op.execute(
+        "INSERT INTO daily_entry_count (category_id, day, count, cancelled_count) "
+        "SELECT category_id, date, COUNT(id), SUM(CASE WHEN cancelled THEN 1 ELSE 0 END) "
+        "FROM entry GROUP BY category_id, date"
+    )
+
+
+def downgrade():
+    op.drop_table('daily_entry_count')
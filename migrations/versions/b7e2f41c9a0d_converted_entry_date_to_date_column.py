@@ -0,0 +1,74 @@
+"""Converted entry date to a native date column with indexes
+
+Revision ID: b7e2f41c9a0d
+Revises: 8d322bf4e7e8
+Create Date: 2026-10-17 09:12:31.402118
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import select
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2f41c9a0d'
+down_revision = '8d322bf4e7e8'
+branch_labels = None
+depends_on = None
+
+metadata = sa.MetaData()
+
+entry_table = sa.Table(
+    'entry', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('date', sa.String(100)),
+)
+
+
+def normalized_dates(conn):
+    """Read every stored date and return it normalized to 'YYYY-MM-DD' together with its entry id.
+
+    Dates are parsed with the same format the entry form used to validate them, so unpadded
+    values like '2024-5-3' are accepted.
+    """
+    rows = conn.execute(select(entry_table.c.id, entry_table.c.date)).fetchall()
+    dates = []
+    for entry_id, value in rows:
+        try:
+            dates.append({'entry_id': entry_id, 'value': datetime.strptime(value.strip(), '%Y-%m-%d').date().isoformat()})
+        except (AttributeError, TypeError, ValueError):
+            raise RuntimeError(f"Entry {entry_id} has an invalid date {value!r}, fix it before upgrading")
+    return dates
+
+
+def upgrade():
+    conn = op.get_bind()
+    dates = normalized_dates(conn)
+
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.alter_column('date',
+               existing_type=sa.String(length=100),
+               type_=sa.Date(),
+               existing_nullable=False,
+               postgresql_using='date::date')
+        batch_op.create_index(batch_op.f('ix_entry_date'), ['date'], unique=False)
+        batch_op.create_index('ix_entry_category_id_date', ['category_id', 'date'], unique=False)
+
+    # SQLite copies the column with CAST(date AS DATE), which truncates the text to the year,
+    # so the normalized values are written back once the table has been rebuilt
+    if dates:
+        conn.execute(
+            entry_table.update().where(entry_table.c.id == sa.bindparam('entry_id')).values(date=sa.bindparam('value')),
+            dates
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.drop_index('ix_entry_category_id_date')
+        batch_op.drop_index(batch_op.f('ix_entry_date'))
+        batch_op.alter_column('date',
+               existing_type=sa.Date(),
+               type_=sa.String(length=100),
+               existing_nullable=False)
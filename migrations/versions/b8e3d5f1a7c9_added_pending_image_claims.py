@@ -0,0 +1,26 @@
+"""Added claim time of pending image downloads
+
+Revision ID: b8e3d5f1a7c9
+Revises: a6c2e9f3b7d4
+Create Date: 2026-10-18 09:12:31.402816
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e3d5f1a7c9'
+down_revision = 'a6c2e9f3b7d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('pending_image_claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.drop_column('pending_image_claimed_at')
@@ -0,0 +1,26 @@
+"""Added image format to entries
+
+Revision ID: c3d7e1f5a9b2
+Revises: 9a4f6d2c8e15
+Create Date: 2026-10-17 15:21:09.734512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d7e1f5a9b2'
+down_revision = '9a4f6d2c8e15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('image_format', sa.String(length=10), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.drop_column('image_format')
@@ -0,0 +1,58 @@
+"""Added precomputed color_hex_variation to categories
+
+Revision ID: e5a8c3b2d71f
+Revises: 4c9d0e7a1f3b
+Create Date: 2026-10-17 13:26:05.771942
+
+"""
+from colorsys import rgb_to_hls, hls_to_rgb
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import select
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a8c3b2d71f'
+down_revision = '4c9d0e7a1f3b'
+branch_labels = None
+depends_on = None
+
+metadata = sa.MetaData()
+
+category_table = sa.Table(
+    'category', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('color_hex', sa.String(10)),
+    sa.Column('color_hex_variation', sa.String(10)),
+)
+
+
+def color_variation(color, adjustment_factor=0.9):
+    """Same computation as app.helpers.adjust_lightness at the time of this migration, None for invalid colors."""
+    try:
+        value = color.lstrip('#')
+        lv = len(value)
+        r, g, b = (int(value[i:i + lv // 3], 16) for i in range(0, lv, lv // 3))
+    except (AttributeError, ValueError):
+        return None
+    h, l, s = rgb_to_hls(r/255., g/255., b/255.)
+    l = max(0, min(1, l * adjustment_factor))
+    r, g, b = hls_to_rgb(h, l, s)
+    return '#%02x%02x%02x' % (int(r * 255), int(g * 255), int(b * 255))
+
+
+def upgrade():
+    with op.batch_alter_table('category', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('color_hex_variation', sa.String(length=10), nullable=True))
+
+    # Backfill the variation of all existing categories
+    conn = op.get_bind()
+    for category_id, color_hex in conn.execute(select(category_table.c.id, category_table.c.color_hex)).fetchall():
+        conn.execute(
+            category_table.update().where(category_table.c.id == category_id).values(color_hex_variation=color_variation(color_hex))
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('category', schema=None) as batch_op:
+        batch_op.drop_column('color_hex_variation')
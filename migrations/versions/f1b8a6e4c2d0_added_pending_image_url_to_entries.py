@@ -0,0 +1,26 @@
+"""Added pending image URL to entries
+
+Revision ID: f1b8a6e4c2d0
+Revises: c3d7e1f5a9b2
+Create Date: 2026-10-17 16:02:44.590127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b8a6e4c2d0'
+down_revision = 'c3d7e1f5a9b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('pending_image_url', sa.String(length=1000), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.drop_column('pending_image_url')
@@ -3,6 +3,7 @@ from app import create_app, db
 from app.config import TestConfig
 from app.models import Entry, Category
 from unittest import mock
+from datetime import date
 
 @pytest.fixture(scope='function')
 def test_client():
@@ -33,7 +34,7 @@ def init_database():
         db.session.commit()
 
     # Populate the database with a single entry
-    entry = Entry(date="2021-05-20", category_id=category1.id, title="John's Birthday", description="Birthday party")
+    entry = Entry(date=date(2021, 5, 20), category_id=category1.id, title="John's Birthday", description="Birthday party")
     db.session.add(entry)
     db.session.commit()
 
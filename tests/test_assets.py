@@ -0,0 +1,34 @@
+import re
+from app.assets import build_asset_manifest
+
+def test_build_asset_manifest(tmp_path):
+    # Given: A static folder with two files in nested directories
+    # When: The manifest is built
+    # Then: It should map the relative paths to content hashes that change with the content
+    (tmp_path / 'css').mkdir()
+    (tmp_path / 'css' / 'style.css').write_text('body {}')
+    (tmp_path / 'app.js').write_text('let a = 1;')
+
+    manifest = build_asset_manifest(str(tmp_path))
+    assert set(manifest) == {'css/style.css', 'app.js'}
+
+    (tmp_path / 'app.js').write_text('let a = 2;')
+    assert build_asset_manifest(str(tmp_path))['app.js'] != manifest['app.js']
+
+def test_static_urls_are_hashed_and_immutable(test_client):
+    # Given: The timeline page
+    # When: Its stylesheet is requested with the hashed URL and without the hash
+    # Then: Only the hashed URL should be cached as immutable
+    html = test_client.get('/timeline').data.decode()
+    url = re.search(r'href="(/static/timeline/style\.css\?v=[0-9a-f]+)"', html).group(1)
+
+    response = test_client.get(url)
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+
+    response = test_client.get('/static/timeline/style.css')
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+
+    response = test_client.get('/static/timeline/style.css?v=outdated')
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
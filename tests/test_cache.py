@@ -0,0 +1,220 @@
+import json
+from unittest import mock
+import time
+from threading import Event, Thread
+from datetime import date, datetime, timedelta, timezone
+from werkzeug.http import http_date
+from app import db
+from app.models import Entry, Category, DataVersion
+from app.cache import VersionedCache, get_data_version, get_data_version_info, bump_data_version
+
+def test_versioned_cache_invalidates_on_new_version():
+    # Given: A cache with a value computed for version 1
+    # When: The same key is requested for version 1 and then for version 2
+    # Then: The value should be recomputed only for the new version
+    cache = VersionedCache(max_size=2)
+    calls = []
+    compute = lambda: calls.append(1) or len(calls)
+
+    assert cache.get_or_compute('key', 1, compute) == 1
+    assert cache.get_or_compute('key', 1, compute) == 1
+    assert cache.get_or_compute('key', 2, compute) == 2
+    assert len(calls) == 2
+
+def test_versioned_cache_evicts_least_recently_used():
+    # Given: A cache with room for two values
+    # When: A third key is added after the first one was used again
+    # Then: The least recently used key should be evicted
+    cache = VersionedCache(max_size=2)
+    cache.get_or_compute('a', 1, lambda: 'a')
+    cache.get_or_compute('b', 1, lambda: 'b')
+    cache.get_or_compute('a', 1, lambda: 'a2')
+    cache.get_or_compute('c', 1, lambda: 'c')
+
+    assert cache.get_or_compute('a', 1, lambda: 'a3') == 'a'
+    assert cache.get_or_compute('b', 1, lambda: 'b2') == 'b2'
+
+def test_versioned_cache_expires_values_after_max_age():
+    # Given: A cache with a max age of 10 seconds and two values stored 5 seconds apart
+    # When: The first value is 10 seconds old
+    # Then: Only the first value should be recomputed, each value expires on its own
+    cache = VersionedCache(max_size=2, max_age=10)
+    with mock.patch('app.cache.monotonic', return_value=100):
+        cache.get_or_compute('a', 0, lambda: 'a')
+    with mock.patch('app.cache.monotonic', return_value=105):
+        cache.get_or_compute('b', 0, lambda: 'b')
+    with mock.patch('app.cache.monotonic', return_value=110):
+        assert cache.get_or_compute('a', 0, lambda: 'a2') == 'a2'
+        assert cache.get_or_compute('b', 0, lambda: 'b2') == 'b'
+
+def test_bump_data_version(test_client):
+    # Given: The data version after migrations
+    # When: It is bumped and committed
+    # Then: It should be incremented by one
+    version = get_data_version(db)
+    bump_data_version(db)
+    db.session.commit()
+    assert get_data_version(db) == version + 1
+
+def test_api_data_is_cached_until_a_write(test_client, init_database):
+    # Given: A cached /api/data response
+    # When: An entry is added without bumping the version, and then through a write route
+    # Then: The cached data should be returned until the write route bumps the version
+    test_client.get('/api/data')
+
+    category = db.session.query(Category).filter_by(name="Release").first()
+    db.session.add(Entry(date=date(2022, 1, 1), category_id=category.id, title="Silent Insert"))
+    db.session.commit()
+    assert len(json.loads(test_client.get('/api/data').data)['entries']) == 1
+
+    test_client.post('/create', data={'date': "2022-02-01", 'category': "Release", 'title': "Created"})
+    titles = [entry['title'] for entry in json.loads(test_client.get('/api/data').data)['entries']]
+    assert titles == ["John's Birthday", "Silent Insert", "Created"]
+
+def test_conditional_get_on_data_version(test_client, init_database):
+    # Given: A /timeline response with ETag and Last-Modified headers
+    # When: The same URL is requested again with those validators, before and after a write
+    # Then: It should answer 304 until the data version changes
+    response = test_client.get('/timeline?categories=Birthday')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+    assert 'no-cache' in response.headers['Cache-Control']
+
+    response = test_client.get('/timeline?categories=Birthday', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.data == b''
+
+    # Other parameters produce another representation
+    response = test_client.get('/timeline?categories=Release', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+    test_client.post('/toggle_cancelled/1')
+    response = test_client.get('/timeline?categories=Birthday', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+def test_conditional_get_if_modified_since(test_client, init_database):
+    # Given: An /api/data response with a Last-Modified header
+    # When: It is requested again with If-Modified-Since
+    # Then: It should answer 304
+    response = test_client.get('/api/data')
+    response = test_client.get('/api/data', headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert response.status_code == 304
+
+def test_conditional_get_within_the_second_of_a_write(test_client, init_database):
+    # Given: A write in the current second, after a client got the Last-Modified of this second
+    # When: The client revalidates with If-Modified-Since, or with an outdated ETag
+    # Then: It should get the new data, since Last-Modified cannot tell both writes apart
+    bump_data_version(db)
+    db.session.commit()
+    response = test_client.get('/api/data')
+    assert 'Last-Modified' not in response.headers
+    last_modified = http_date(datetime.now(timezone.utc))
+
+    response = test_client.get('/api/data', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+
+    response = test_client.get('/api/data', headers={'If-Modified-Since': last_modified, 'If-None-Match': '"outdated"'})
+    assert response.status_code == 200
+
+def test_conditional_get_prefers_etag(test_client, init_database):
+    # Given: A write that happened more than a second ago
+    # When: The data is revalidated with a matching date but an outdated ETag
+    # Then: The ETag should decide
+    db.session.query(DataVersion).update({DataVersion.updated_at: datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=1)})
+    db.session.commit()
+    response = test_client.get('/api/data')
+    last_modified = response.headers['Last-Modified']
+
+    assert test_client.get('/api/data', headers={'If-Modified-Since': last_modified}).status_code == 304
+    response = test_client.get('/api/data', headers={'If-Modified-Since': last_modified, 'If-None-Match': '"outdated"'})
+    assert response.status_code == 200
+
+def test_versioned_cache_serves_stale_while_computing():
+    # Given: A cached value for version 1 and a thread computing version 2
+    # When: The key is requested for version 2 meanwhile
+    # Then: The stale value should be returned without a second computation
+    cache = VersionedCache(max_size=2)
+    cache.get_or_compute('key', 1, lambda: 'old')
+    started, release = Event(), Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'new'
+
+    worker = Thread(target=cache.get_or_compute_stale, args=('key', 2, compute))
+    worker.start()
+    started.wait()
+    assert cache.get_or_compute_stale('key', 2, compute) == ('old', True)
+    release.set()
+    worker.join()
+
+    assert cache.get_or_compute_stale('key', 2, compute) == ('new', False)
+    assert len(calls) == 1
+
+def test_versioned_cache_computes_once_for_concurrent_misses():
+    # Given: An empty cache
+    # When: Several threads request the same key at once
+    # Then: The value should be computed a single time and returned to all of them
+    cache = VersionedCache(max_size=2)
+    calls, results = [], []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'value'
+
+    workers = [Thread(target=lambda: results.append(cache.get_or_compute('key', 1, compute))) for _ in range(5)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert results == ['value'] * 5
+    assert len(calls) == 1
+
+def test_timeline_html_is_cached_until_a_write(test_client, init_database):
+    # Given: A rendered /timeline page
+    # When: An entry is added without bumping the version, and then through a write route
+    # Then: The cached page should be served until the write route bumps the version
+    first = test_client.get('/timeline').data
+
+    category = db.session.query(Category).filter_by(name="Release").first()
+    db.session.add(Entry(date=date.today(), category_id=category.id, title="Silent Insert"))
+    db.session.commit()
+    assert test_client.get('/timeline').data == first
+
+    test_client.post('/create', data={'date': date.today().isoformat(), 'category': "Release", 'title': "Created"})
+    html = test_client.get('/timeline').data
+    assert b"Silent Insert" in html
+    assert b"Created" in html
+
+def test_stale_timeline_is_not_validated(test_client, init_database, monkeypatch):
+    # Given: A timeline cache that answers with a stale page
+    # When: /timeline is requested
+    # Then: The stale page should be sent without ETag and Last-Modified
+    monkeypatch.setattr(test_client.application.extensions['timeline_cache'], 'get_or_compute_stale',
+                        lambda key, version, compute: ('<p>stale</p>', True))
+    response = test_client.get('/timeline')
+    assert response.data == b'<p>stale</p>'
+    assert 'ETag' not in response.headers
+    assert 'Last-Modified' not in response.headers
+    assert 'no-cache' in response.headers['Cache-Control']
+
+def test_data_version_is_read_once_per_request(test_client, init_database):
+    # Given: Cached /timeline and /api/data responses
+    # When: They are requested again
+    # Then: The data version should only be read by the conditional GET
+    test_client.get('/timeline')
+    test_client.get('/api/data')
+
+    with mock.patch('app.cache.get_data_version_info', wraps=get_data_version_info) as version_info:
+        assert test_client.get('/timeline').status_code == 200
+        assert version_info.call_count == 1
+        assert test_client.get('/api/data').status_code == 200
+        assert version_info.call_count == 2
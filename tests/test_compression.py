@@ -0,0 +1,105 @@
+import gzip
+import json
+import os
+from app.compression import precompress_static_files, find_precompressed_static_files, negotiate_encoding, compress_stream
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+def test_negotiate_encoding():
+    # Given: Accept-Encoding headers with and without quality values
+    # When: An encoding is negotiated out of brotli and gzip
+    # Then: The accepted encoding with the highest quality should be chosen, None for identity
+    encodings = ('br', 'gzip')
+    assert negotiate_encoding(parse_accept_header('gzip, deflate, br', Accept), encodings) == 'br'
+    assert negotiate_encoding(parse_accept_header('br;q=0.5, gzip', Accept), encodings) == 'gzip'
+    assert negotiate_encoding(parse_accept_header('identity', Accept), encodings) is None
+    assert negotiate_encoding(parse_accept_header('', Accept), encodings) is None
+
+def test_precompress_static_files(tmp_path):
+    # Given: A static folder with a stylesheet and an image
+    # When: The static files are precompressed
+    # Then: Only the stylesheet should get a gzip sibling with the same content
+    (tmp_path / 'style.css').write_text('body { color: red; }' * 100)
+    (tmp_path / 'image.png').write_bytes(b'\x89PNG')
+
+    variants = precompress_static_files(str(tmp_path))
+    assert 'style.css.gz' in variants
+    assert not any(variant.startswith('image.png') for variant in variants)
+    assert gzip.decompress((tmp_path / 'style.css.gz').read_bytes()) == (tmp_path / 'style.css').read_bytes()
+
+def test_static_file_is_served_precompressed(test_client, tmp_path):
+    # Given: A static script whose gzip sibling was written by the build step, and an outdated stylesheet sibling
+    # When: They are requested with and without gzip in Accept-Encoding
+    # Then: Only the up to date sibling should be served, and only when accepted
+    app = test_client.application
+    (tmp_path / 'script.js').write_text('console.log("calendarium");\n' * 100)
+    precompress_static_files(str(tmp_path))
+    (tmp_path / 'style.css').write_text('body { color: red; }' * 100)
+    (tmp_path / 'style.css.gz').write_bytes(gzip.compress(b'outdated'))
+    os.utime(tmp_path / 'style.css.gz', (0, 0))
+    app.static_folder = str(tmp_path)
+    app.extensions['precompressed_static'].clear()
+    app.extensions['precompressed_static'].update(find_precompressed_static_files(str(tmp_path)))
+
+    plain = test_client.get('/static/script.js', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in plain.headers
+
+    response = test_client.get('/static/script.js', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype == 'text/javascript'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == plain.data
+    assert len(response.data) < len(plain.data)
+
+    response = test_client.get('/static/style.css', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+def test_app_start_does_not_write_static_files(test_client):
+    # Given: A started app
+    # When: The static folder is searched for compressed siblings
+    # Then: None should have been written, they are created by the build step
+    static_folder = test_client.application.static_folder
+    assert not [name for _, _, files in os.walk(static_folder) for name in files if name.endswith(('.gz', '.br'))]
+
+def test_dynamic_response_is_compressed(test_client, init_database):
+    # Given: A timeline page larger than the compression threshold
+    # When: It is requested with gzip in Accept-Encoding, and again with its ETag
+    # Then: It should be gzip compressed with a weak ETag that still answers 304
+    response = test_client.get('/timeline', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert b'<html' in gzip.decompress(response.data)
+    assert response.headers['ETag'].startswith('W/')
+
+    response = test_client.get('/timeline', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+def test_small_and_streamed_responses(test_client, init_database):
+    # Given: A small JSON response and a streamed one
+    # When: Both are requested with gzip in Accept-Encoding
+    # Then: The small one should be sent as is and the streamed one compressed on the fly
+    response = test_client.get('/api/entries', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+    response = test_client.get('/api/data?stream=true', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.data))['entries'][0]['title'] == "John's Birthday"
+
+def test_compress_stream_flushes_rarely():
+    # Given: Many small chunks of JSON
+    # When: They are compressed as a stream
+    # Then: The result should be about as small as compressing them at once
+    chunks = [f'{{"id": {i}, "title": "Entry {i}"}},'.encode() for i in range(5000)]
+    streamed = b''.join(compress_stream(chunks, 'gzip'))
+
+    assert gzip.decompress(streamed) == b''.join(chunks)
+    assert len(streamed) < len(gzip.compress(b''.join(chunks))) * 1.1
+
+def test_not_modified_keeps_weak_etag(test_client, init_database):
+    # Given: A compressed timeline page with a weak ETag
+    # When: It is revalidated
+    # Then: The 304 should carry the same validator
+    response = test_client.get('/timeline', headers={'Accept-Encoding': 'gzip'})
+    etag = response.headers['ETag']
+    response = test_client.get('/timeline', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
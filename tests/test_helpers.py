@@ -1,49 +1,51 @@
+import json
 from io import BytesIO
 from os import path
 from urllib.parse import unquote_plus
 import zipfile
 from flask.testing import FlaskClient
 from unittest import mock
-from datetime import datetime
+from datetime import datetime, date
 from app.models import Entry, Category
 from app import db
 from app.helpers import (
-    handle_image_upload, download_giphy_image, is_valid_giphy_url, handle_image, 
-    parse_date, allowed_file, get_entry_data, create_zip
+    download_giphy_image, is_valid_giphy_url, handle_image, 
+    parse_date, move_to_year, allowed_file, get_entry_data, create_zip,
+    format_entry_date, prewarm_date_formats, is_known_locale, iter_json
 )
 
-def test_handle_image_upload_file(mock_file: mock.Mock, test_client: FlaskClient):
-    # Given: A mocked file and handle_image function
-    # When: handle_image_upload is called with a file
-    # Then: It should return the filename processed by handle_image
-    with mock.patch('app.helpers.handle_image') as mock_handle_image:
-        mock_handle_image.return_value = 'test.jpg'
-        result = handle_image_upload(1, mock_file, None, 'uploads', {'jpg', 'png'})
-        assert result == 'test.jpg'
-
-def test_handle_image_upload_giphy(test_client: FlaskClient):
-    # Given: A mocked download_giphy_image function
-    # When: handle_image_upload is called with a GIPHY URL
-    # Then: It should return the GIF filename processed by download_giphy_image
-    with mock.patch('app.helpers.download_giphy_image') as mock_download_giphy_image:
-        mock_download_giphy_image.return_value = '1.gif'
-        result = handle_image_upload(1, None, 'https://media.giphy.com/media/test.gif', 'uploads', {'gif'})
-        assert result == '1.gif'
-
-def test_download_giphy_image_valid(test_client: FlaskClient):
-    # Given: A mocked successful HTTP response for a valid GIPHY URL
+def mock_download(chunks, status_code=200, headers=None):
+    response = mock.MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.iter_content.return_value = iter(chunks)
+    response.__enter__.return_value = response
+    return mock.patch('app.helpers.http_session.get', return_value=response)
+
+def test_download_giphy_image_valid(test_client: FlaskClient, tmp_path):
+    # Given: A mocked successful streamed HTTP response for a valid GIPHY URL
     # When: download_giphy_image is called with a valid URL
-    # Then: It should return the expected filename
-    with mock.patch('requests.get') as mock_get:
-        mock_response = mock.Mock()
-        mock_response.status_code = 200
-        mock_response.content = b'test content'
-        mock_get.return_value = mock_response
-
-        with mock.patch('builtins.open', mock.mock_open()) as mock_file:
-            with mock.patch('app.helpers.create_upload_folder'):
-                result = download_giphy_image('https://media.giphy.com/media/test.gif', 1, 'uploads')
-                assert result == '1.gif'
+    # Then: It should return the expected filename and leave only the complete file
+    with mock_download([b'GIF89a', b'test content']) as mock_get:
+        result = download_giphy_image('https://media.giphy.com/media/test.gif', 1, str(tmp_path))
+    assert result == '1.gif'
+    assert (tmp_path / '1.gif').read_bytes() == b'GIF89atest content'
+    assert [file.name for file in tmp_path.iterdir()] == ['1.gif']
+    assert mock_get.call_args.kwargs['stream'] is True
+    assert mock_get.call_args.kwargs['timeout']
+
+def test_download_giphy_image_too_large(test_client: FlaskClient, tmp_path):
+    # Given: Responses that announce or stream more than the maximum download size
+    # When: download_giphy_image is called
+    # Then: It should abort without leaving a file behind
+    test_client.application.config['GIPHY_DOWNLOAD_MAX_BYTES'] = 10
+    with mock_download([b'x'], headers={'Content-Length': '11'}):
+        assert download_giphy_image('https://media.giphy.com/media/test.gif', 1, str(tmp_path)) is None
+    with mock_download([b'x' * 6, b'x' * 6]):
+        assert download_giphy_image('https://media.giphy.com/media/test.gif', 1, str(tmp_path)) is None
+    with mock_download([b'x'], status_code=404):
+        assert download_giphy_image('https://media.giphy.com/media/test.gif', 1, str(tmp_path)) is None
+    assert list(tmp_path.iterdir()) == []
 
 def test_download_giphy_image_invalid_url(test_client: FlaskClient):
     # Given: An invalid URL
@@ -96,6 +98,35 @@ def test_parse_date_with_invalid_formats():
     assert parse_date('2021-04-31') is None  # Invalid day
     assert parse_date('') is None  # Empty string  # Empty string is valid input case
 
+def test_move_to_year():
+    # Given: Dates including a leap day
+    # When: move_to_year is called
+    # Then: It should keep month and day, mapping 29 February to 28 February in non-leap years
+    assert move_to_year(date(2020, 5, 20), 2025) == date(2025, 5, 20)
+    assert move_to_year(date(2020, 2, 29), 2025) == date(2025, 2, 28)
+    assert move_to_year(date(2020, 2, 29), 2028) == date(2028, 2, 29)
+
+def test_format_entry_date_is_cached():
+    # Given: A prewarmed date format cache
+    # When: A date inside the prewarmed range is formatted
+    # Then: It should be served from the cache in the requested locale
+    format_entry_date.cache_clear()
+    prewarm_date_formats(date(2024, 5, 1), 31, 'en_US', 'MMMM d')
+    assert format_entry_date.cache_info().currsize == 31
+
+    assert format_entry_date(date(2024, 5, 20), 'en_US', 'MMMM d') == 'May 20'
+    assert format_entry_date.cache_info().hits == 1
+    assert format_entry_date(date(2024, 5, 20), 'de_DE', 'd. MMMM') == '20. Mai'
+
+def test_is_known_locale():
+    # Given: Known and unknown locale identifiers
+    # When: They are checked
+    # Then: Only locales with Babel data should be accepted
+    assert is_known_locale('de_DE')
+    assert is_known_locale('en')
+    assert not is_known_locale('xx_YY')
+    assert not is_known_locale('not a locale')
+
 def test_allowed_file():
     # Given: Filename and allowed extensions
     # When: Checking if a file is allowed
@@ -122,13 +153,6 @@ def test_allowed_file_with_various_extensions():
     assert not allowed_file('', allowed_extensions)
 
 
-def test_handle_image_upload_with_invalid_giphy_url(test_client):
-    """
-    Test handle_image_upload function with an invalid GIPHY URL
-    """
-    result = handle_image_upload(1, None, 'https://invalid-giphy.com/media/test.gif', 'uploads', {'gif'})
-    assert result is None
-
 def test_get_data(test_client: FlaskClient, init_database: None):
     # Given: An initialized database and test_client context
     # When: get_data is called
@@ -210,3 +234,14 @@ def test_create_zip_with_missing_files(test_client):
             # Should not attempt to write non-existent files
             assert not zip_file_instance.write.called
 
+def test_iter_json_buffers_chunks(test_client):
+    # Given: A dict with a generator of many small entries
+    # When: It is encoded with a chunk size of 1000 characters
+    # Then: It should be valid JSON sent in a few chunks of at least that size
+    data = {'entries': ({'id': i, 'title': f"Entry {i}"} for i in range(500)), 'categories': [{'name': "Test"}]}
+    chunks = list(iter_json(data, chunk_size=1000))
+
+    assert json.loads(''.join(chunks)) == {'entries': [{'id': i, 'title': f"Entry {i}"} for i in range(500)],
+                                           'categories': [{'name': "Test"}]}
+    assert len(chunks) < 20
+    assert all(len(chunk) >= 1000 for chunk in chunks[:-1])
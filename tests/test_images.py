@@ -0,0 +1,237 @@
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import Event
+from unittest import mock
+from PIL import Image
+from app import db
+from app.models import Entry
+from app.images import (
+    generate_image_variants, transcode_animated_gif, process_entry_image, ingest_giphy_image, pick_image_variant,
+    variant_width, claim_image_ingestion, resume_image_ingestion, submit_image_job_later
+)
+
+def write_image(filepath, size, **kwargs):
+    Image.new('RGB', size, 'red').save(filepath, **kwargs)
+
+def test_generate_image_variants(tmp_path):
+    # Given: A 1000 px wide image
+    # When: Variants of 320, 640 and 1280 px are generated
+    # Then: Only the narrower ones should be written, downscaled with the aspect ratio kept
+    write_image(tmp_path / '1.png', (1000, 500))
+
+    variants = generate_image_variants(str(tmp_path), '1.png', (1280, 320, 640))
+    assert variants == ['1.w320.webp', '1.w640.webp']
+    assert [variant_width(variant) for variant in variants] == [320, 640]
+    with Image.open(tmp_path / '1.w320.webp') as variant:
+        assert variant.size == (320, 160)
+
+def test_generate_image_variants_skips_animations(tmp_path):
+    # Given: An animated GIF
+    # When: Variants are generated
+    # Then: None should be written
+    frames = [Image.new('RGB', (800, 800), color) for color in ('red', 'blue')]
+    frames[0].save(tmp_path / '1.gif', save_all=True, append_images=frames[1:])
+    assert generate_image_variants(str(tmp_path), '1.gif', (320,)) == []
+
+def test_pick_image_variant():
+    # Given: A formatted entry with two variants
+    # When: Variants for different minimum widths are picked
+    # Then: The narrowest adequate one, or the original, should be returned
+    entry = {'image_url': '/uploads/1.png', 'image_variants': [
+        {'width': 320, 'url': '/uploads/1.w320.webp'}, {'width': 640, 'url': '/uploads/1.w640.webp'}
+    ]}
+    assert pick_image_variant(entry, 100) == '/uploads/1.w320.webp'
+    assert pick_image_variant(entry, 640) == '/uploads/1.w640.webp'
+    assert pick_image_variant(entry, 1000) == '/uploads/1.png'
+    assert pick_image_variant({'image_url': None, 'image_variants': []}, 640) is None
+
+def test_uploaded_image_variants(test_client, init_database, tmp_path):
+    # Given: An entry created with an uploaded 2000 px wide image
+    # When: The data and the timeline are requested and the entry is deleted
+    # Then: The variants should be listed, used by the timeline, and removed with the entry
+    test_client.application.config['UPLOAD_FOLDER'] = str(tmp_path)
+    image = io.BytesIO()
+    write_image(image, (2000, 1000), format='JPEG')
+    image.seek(0)
+    test_client.post('/create', data={'date': '2030-01-01', 'category': 'Release', 'title': 'With Image',
+                                      'entryImage': (image, 'photo.jpg')}, content_type='multipart/form-data')
+
+    db.session.expire_all()  # The variants were recorded by the image worker in its own session
+    entry = db.session.query(Entry).filter_by(title='With Image').first()
+    assert entry.image_variants == f"{entry.id}.w320.webp,{entry.id}.w640.webp,{entry.id}.w1280.webp"
+
+    data = json.loads(test_client.get('/api/data').data)
+    formatted = next(e for e in data['entries'] if e['title'] == 'With Image')
+    assert [variant['width'] for variant in formatted['image_variants']] == [320, 640, 1280]
+    assert formatted['image_variants'][1]['url'].startswith(f"/uploads/{entry.id}.w640.webp?v=")
+    assert f"/uploads/{entry.id}.w640.webp?v=" in test_client.get('/timeline').data.decode()
+
+    test_client.post(f'/delete/{entry.id}')
+    assert list(tmp_path.iterdir()) == []
+
+def write_animation(filepath, size=(200, 200), frames=8):
+    images = [Image.new('RGB', size, (i * 30 % 256, 80, 160)) for i in range(frames)]
+    images[0].save(filepath, save_all=True, append_images=images[1:], duration=100, loop=0)
+
+def test_transcode_animated_gif(tmp_path):
+    # Given: An animated GIF and a still GIF
+    # When: Both are transcoded
+    # Then: Only the animation should be converted to a smaller animated WebP, keeping its frames
+    write_animation(tmp_path / '1.gif')
+    Image.new('RGB', (200, 200), 'red').save(tmp_path / '2.gif')
+
+    assert transcode_animated_gif(str(tmp_path), '1.gif') == '1.webp'
+    with Image.open(tmp_path / '1.webp') as webp:
+        assert webp.is_animated
+        assert webp.n_frames == 8
+    assert (tmp_path / '1.webp').stat().st_size < (tmp_path / '1.gif').stat().st_size
+    assert transcode_animated_gif(str(tmp_path), '2.gif') is None
+    assert not (tmp_path / '2.webp').exists()
+
+def test_animated_gif_entry_is_served_as_webp(test_client, init_database, tmp_path):
+    # Given: An entry whose image is an animated GIF, as downloaded from Giphy
+    # When: The image is processed with transcoding enabled and disabled
+    # Then: The entry should switch to the WebP and record its format, or keep the GIF
+    test_client.application.config['UPLOAD_FOLDER'] = str(tmp_path)
+    write_animation(tmp_path / '1.gif')
+    entry = db.session.get(Entry, 1)
+    entry.image_filename = '1.gif'
+    db.session.commit()
+
+    test_client.application.config['TRANSCODE_ANIMATED_GIFS'] = False
+    process_entry_image(test_client.application, 1, '1.gif')
+    db.session.expire_all()
+    assert (entry.image_filename, entry.image_format, entry.image_variants) == ('1.gif', 'gif', None)
+
+    test_client.application.config['TRANSCODE_ANIMATED_GIFS'] = True
+    process_entry_image(test_client.application, 1, '1.gif')
+    db.session.expire_all()
+    assert (entry.image_filename, entry.image_format) == ('1.webp', 'webp')
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['1.webp']
+    assert json.loads(test_client.get('/api/data').data)['entries'][0]['image_url'].startswith('/uploads/1.webp?v=')
+
+GIPHY_URL = 'https://media.giphy.com/media/test/giphy.gif'
+
+def test_giphy_image_is_ingested_after_create(test_client, init_database, tmp_path):
+    # Given: Inline image processing and a Giphy download that fails twice before it succeeds
+    # When: An entry is created with the Giphy URL and the pending downloads are resumed after the lease
+    # Then: The entry should stay pending without waiting for retries, and get the image from the resumed download
+    test_client.application.config.update(UPLOAD_FOLDER=str(tmp_path), IMAGE_INGEST_BACKOFF=60, IMAGE_INGEST_LEASE=0)
+    attempts = []
+
+    def download(url, entry_id, upload_folder, filename):
+        attempts.append(db.session.query(Entry).filter_by(id=entry_id).one().pending_image_url)
+        if len(attempts) < 3:
+            return None
+        Image.new('RGB', (100, 100), 'red').save(tmp_path / filename, format='GIF')
+        return filename
+
+    with mock.patch('app.helpers.download_giphy_image', side_effect=download):
+        started = time.monotonic()
+        test_client.post('/create', data={'date': '2030-01-01', 'category': 'Release', 'title': 'Giphy',
+                                          'giphyUrl': GIPHY_URL})
+        assert time.monotonic() - started < 5
+        assert db.session.query(Entry).filter_by(title='Giphy').one().pending_image_url == GIPHY_URL
+        resume_image_ingestion()
+        resume_image_ingestion()
+
+    assert attempts == [GIPHY_URL] * 3
+    db.session.expire_all()
+    entry = db.session.query(Entry).filter_by(title='Giphy').one()
+    assert entry.pending_image_url is None
+    assert entry.image_filename.startswith(f"{entry.id}-") and entry.image_filename.endswith('.gif')
+    assert entry.image_format == 'gif'
+    assert (tmp_path / entry.image_filename).exists()
+
+def test_failed_giphy_ingestion_clears_pending_state(test_client, init_database, tmp_path):
+    # Given: An entry waiting for a Giphy image that can never be downloaded
+    # When: The ingestion job runs out of retries
+    # Then: The entry should end up without image and without pending state
+    test_client.application.config.update(UPLOAD_FOLDER=str(tmp_path), IMAGE_INGEST_RETRIES=1)
+    entry = db.session.get(Entry, 1)
+    entry.pending_image_url = GIPHY_URL
+    db.session.commit()
+    assert json.loads(test_client.get('/api/data').data)['entries'][0]['image_pending'] is True
+
+    with mock.patch('app.helpers.download_giphy_image', return_value=None) as download:
+        ingest_giphy_image(test_client.application, 1, GIPHY_URL, attempt=1)
+    assert download.call_count == 1
+    db.session.expire_all()
+    assert (entry.pending_image_url, entry.image_filename) == (None, None)
+
+def test_outdated_giphy_ingestion_is_discarded(test_client, init_database, tmp_path):
+    # Given: An entry that got another image while a Giphy download was running
+    # When: The download finishes
+    # Then: The downloaded file should be removed and the entry left unchanged
+    test_client.application.config['UPLOAD_FOLDER'] = str(tmp_path)
+    entry = db.session.get(Entry, 1)
+    entry.pending_image_url = GIPHY_URL
+    db.session.commit()
+
+    def download(url, entry_id, upload_folder, filename):
+        (tmp_path / filename).write_bytes(b'GIF89a')
+        db.session.query(Entry).filter_by(id=entry_id).update({Entry.pending_image_url: None, Entry.image_filename: '1.png'})
+        db.session.commit()
+        return filename
+
+    with mock.patch('app.helpers.download_giphy_image', side_effect=download):
+        ingest_giphy_image(test_client.application, 1, GIPHY_URL)
+    db.session.expire_all()
+    assert entry.image_filename == '1.png'
+    assert list(tmp_path.iterdir()) == []
+
+def test_claim_image_ingestion(test_client, init_database):
+    # Given: An entry waiting for a Giphy image
+    # When: Two workers try to claim the download, before and after the lease expired
+    # Then: Only one should get it at a time, and its claim should renew
+    app = test_client.application
+    entry = db.session.get(Entry, 1)
+    entry.pending_image_url = GIPHY_URL
+    db.session.commit()
+
+    claim = claim_image_ingestion(app, 1, GIPHY_URL)
+    assert claim is not None
+    assert claim_image_ingestion(app, 1, GIPHY_URL) is None
+    assert claim_image_ingestion(app, 1, 'https://media.giphy.com/media/other/giphy.gif') is None
+    renewed = claim_image_ingestion(app, 1, GIPHY_URL, claim)
+    assert renewed is not None
+
+    db.session.query(Entry).filter_by(id=1).update({Entry.pending_image_claimed_at: renewed - timedelta(seconds=app.config['IMAGE_INGEST_LEASE'] + 1)})
+    db.session.commit()
+    assert claim_image_ingestion(app, 1, GIPHY_URL) is not None
+    assert claim_image_ingestion(app, 1, GIPHY_URL, renewed) is None
+
+def test_claimed_giphy_ingestion_runs_once(test_client, init_database):
+    # Given: A pending download that another worker claimed
+    # When: This worker resumes the pending downloads
+    # Then: It should neither schedule nor run the download
+    entry = db.session.get(Entry, 1)
+    entry.pending_image_url = GIPHY_URL
+    db.session.commit()
+    claim_image_ingestion(test_client.application, 1, GIPHY_URL)
+
+    with mock.patch('app.helpers.download_giphy_image') as download:
+        resume_image_ingestion()
+        ingest_giphy_image(test_client.application, 1, GIPHY_URL)
+    assert download.call_count == 0
+    db.session.expire_all()
+    assert entry.pending_image_url == GIPHY_URL
+
+def test_delayed_image_job_does_not_block_workers(test_client):
+    # Given: A single image worker and a job delayed by a retry backoff
+    # When: Another job is submitted meanwhile
+    # Then: It should run right away, before the delayed job
+    app = test_client.application
+    app.extensions['image_executor'] = ThreadPoolExecutor(max_workers=1)
+    finished, delayed_done = [], Event()
+    try:
+        submit_image_job_later(0.5, lambda app: finished.append('delayed') or delayed_done.set())
+        app.extensions['image_executor'].submit(finished.append, 'immediate').result(timeout=0.4)
+        assert finished == ['immediate']
+        assert delayed_done.wait(timeout=2)
+        assert finished == ['immediate', 'delayed']
+    finally:
+        app.extensions['image_executor'].shutdown()
@@ -1,5 +1,6 @@
 from app.models import Quote, Category, QuoteConstants
 from app import db
+from app.helpers import adjust_lightness
 from datetime import datetime, date, timedelta
 from unittest.mock import patch
 import json
@@ -331,10 +332,20 @@ def test_create_category(test_client, init_database):
     assert category is not None
     assert category.symbol == '🌟'
     assert category.color_hex == '#FF5733'
+    assert category.color_hex_variation == adjust_lightness('#FF5733')
     assert category.repeat_annually is True
     assert category.display_celebration is True
     assert category.is_protected is False
 
+def test_color_hex_variation_backfilled_by_migration(test_client):
+    """
+    GIVEN the default categories created by the migrations
+    WHEN their stored gradient variation is read
+    THEN check that it matches the computed variation of their color
+    """
+    for category in Category.query.all():
+        assert category.color_hex_variation == adjust_lightness(category.color_hex)
+
 def test_update_category(test_client, init_database):
     """
     GIVEN a Flask application with an existing category
@@ -370,6 +381,7 @@ def test_update_category(test_client, init_database):
     assert updated_category.name == 'UpdatedCategory'
     assert updated_category.symbol == '🎉'
     assert updated_category.color_hex == '#33FF57'
+    assert updated_category.color_hex_variation == adjust_lightness('#33FF57')
     assert updated_category.repeat_annually is True
     assert updated_category.display_celebration is True
     assert updated_category.is_protected is True
@@ -423,7 +435,7 @@ def test_delete_category_with_entries(test_client, init_database):
     # Create an entry associated with the category
     from app.models import Entry
     entry = Entry(
-        date="2025-01-01",
+        date=date(2025, 1, 1),
         category_id=category.id,
         title="Test Entry",
         description="Test Description",
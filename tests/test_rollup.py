@@ -0,0 +1,110 @@
+import json
+from datetime import date
+from app import db
+from app.models import Entry, Category, DailyEntryCount
+from app.rollup import rebuild_daily_counts
+
+def daily_counts():
+    """Returns the non-empty daily counts as {(category name, day): (count, cancelled_count)}."""
+    rows = db.session.query(Category.name, DailyEntryCount.day, DailyEntryCount.count, DailyEntryCount.cancelled_count) \
+        .join(Category, DailyEntryCount.category_id == Category.id).filter(DailyEntryCount.count > 0).all()
+    return {(name, day): (count, cancelled) for name, day, count, cancelled in rows}
+
+def test_daily_counts_follow_entry_writes(test_client, init_database):
+    # Given: The initial birthday entry on 2021-05-20
+    # When: An entry is added, moved to another day, cancelled and the initial entry is deleted
+    # Then: The daily counts should follow every write
+    assert daily_counts() == {("Birthday", date(2021, 5, 20)): (1, 0)}
+
+    test_client.post('/create', data={'date': "2021-05-20", 'category': "Release", 'title': "Release 1"})
+    entry = db.session.query(Entry).filter_by(title="Release 1").one()
+    assert daily_counts()[("Release", date(2021, 5, 20))] == (1, 0)
+
+    test_client.post(f'/update/{entry.id}', data={'date': "2021-06-01", 'category': "Release", 'title': "Release 1"})
+    assert ("Release", date(2021, 5, 20)) not in daily_counts()
+    assert daily_counts()[("Release", date(2021, 6, 1))] == (1, 0)
+
+    entry = db.session.get(Entry, entry.id)
+    entry.cancelled = True
+    db.session.commit()
+    assert daily_counts()[("Release", date(2021, 6, 1))] == (1, 1)
+
+    test_client.post('/delete/1')
+    assert daily_counts() == {("Release", date(2021, 6, 1)): (1, 1)}
+
+def test_daily_counts_with_category_of_the_same_flush(test_client, init_database):
+    # Given: A new category and an entry that only references it through the relationship
+    # When: Both are committed together, and the entry is later moved after its attributes expired
+    # Then: The entry should be counted for the new category, and then for its new day
+    category = Category(name="Conference", symbol="🎤", color_hex="#123456")
+    entry = Entry(date=date(2024, 1, 1), category=category, title="Conference")
+    db.session.add(entry)
+    db.session.commit()
+    assert daily_counts()[("Conference", date(2024, 1, 1))] == (1, 0)
+
+    entry.date = date(2024, 1, 2)
+    db.session.commit()
+    counts = daily_counts()
+    assert ("Conference", date(2024, 1, 1)) not in counts
+    assert counts[("Conference", date(2024, 1, 2))] == (1, 0)
+
+def test_daily_counts_survive_purge(test_client, init_database):
+    # Given: An old entry of a category that is not protected
+    # When: Old entries are purged
+    # Then: The entry should be gone, but still be counted
+    category = db.session.query(Category).filter_by(name="Release").first()
+    db.session.add(Entry(date=date(2020, 1, 1), category_id=category.id, title="Old Release"))
+    db.session.commit()
+
+    test_client.post('/purge-old-entries')
+
+    assert not db.session.query(Entry).filter_by(title="Old Release").first()
+    assert daily_counts()[("Release", date(2020, 1, 1))] == (1, 0)
+
+def test_daily_counts_keep_last_year_of_serial_entries(test_client, init_database):
+    # Given: The birthday entry of 2021, which repeats annually
+    # When: Serial entries are moved to the current year
+    # Then: The entry should be counted both in 2021 and in the current year
+    test_client.post('/update-serial-entries')
+
+    entry = db.session.get(Entry, 1)
+    counts = daily_counts()
+    assert counts[("Birthday", date(2021, 5, 20))] == (1, 0)
+    assert counts[("Birthday", entry.date)] == (1, 0)
+
+def test_daily_counts_count_batch_import(test_client, init_database):
+    # Given: A batch import of two entries on the same day
+    # When: It is imported
+    # Then: Both entries should be counted
+    data = {"entries": [
+        {"date": "2022-03-01", "category": {"name": "Release"}, "title": "A"},
+        {"date": "2022-03-01", "category": {"name": "Release"}, "title": "B", "cancelled": True},
+    ]}
+    test_client.post('/batch-import', data=json.dumps(data), content_type='application/json')
+
+    assert daily_counts()[("Release", date(2022, 3, 1))] == (2, 1)
+
+def test_rebuild_daily_counts(test_client, init_database):
+    # Given: Daily counts that are out of sync with the entries
+    # When: They are rebuilt
+    # Then: They should match the current entries
+    db.session.query(DailyEntryCount).delete()
+    db.session.commit()
+    assert daily_counts() == {}
+
+    rebuild_daily_counts(db.session)
+    db.session.commit()
+
+    assert daily_counts() == {("Birthday", date(2021, 5, 20)): (1, 0)}
+
+def test_rebuild_daily_counts_command(test_client, init_database):
+    # Given: Missing daily counts
+    # When: The rebuild-daily-counts command is run
+    # Then: The counts should be restored
+    db.session.query(DailyEntryCount).delete()
+    db.session.commit()
+
+    result = test_client.application.test_cli_runner().invoke(args=['rebuild-daily-counts'])
+
+    assert "rebuilt" in result.output
+    assert daily_counts() == {("Birthday", date(2021, 5, 20)): (1, 0)}
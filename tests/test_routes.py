@@ -1,9 +1,18 @@
-from app.helpers import get_entry_data
-from app.models import Entry, Category
+from app.helpers import get_entry_data, create_http_session
+from app.models import Entry, Category, Quote, DailyEntryCount
 from app import db
 from datetime import datetime, date, timedelta
-from sqlalchemy import not_
+from sqlalchemy import not_, func, text
+from flask_migrate import upgrade, downgrade
 import json
+import os
+import time
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+from app.cache import bump_data_version
 
 def test_home_page(test_client):
     """
@@ -70,6 +79,46 @@ def test_create_entry_with_future_date(test_client, init_database):
     assert entry is not None
     assert str(entry.date) == future_date
 
+def test_create_entry_with_uploaded_image(test_client, init_database, mock_file):
+    """
+    GIVEN a Flask application
+    WHEN an entry is created with an uploaded image
+    THEN check that the saved image is assigned and processed after the commit
+    """
+    with mock.patch('app.routes.handle_image', return_value='test.jpg') as handle_image, \
+            mock.patch('app.routes.schedule_image_processing') as schedule_image_processing:
+        test_client.post('/create', data={'date': "2030-01-01", 'category': "Release", 'title': "Upload"})
+    entry = db.session.query(Entry).filter_by(title="Upload").one()
+    assert handle_image.call_args.args[1] == entry.id
+    assert entry.image_filename == 'test.jpg'
+    schedule_image_processing.assert_called_once_with(entry.id, 'test.jpg')
+
+def test_create_entry_with_giphy_url(test_client, init_database):
+    """
+    GIVEN a Flask application
+    WHEN an entry is created with a Giphy URL
+    THEN check that the entry waits for the image and its download is scheduled after the commit
+    """
+    giphy_url = 'https://media.giphy.com/media/test.gif'
+    with mock.patch('app.routes.schedule_image_ingestion') as schedule_image_ingestion:
+        test_client.post('/create', data={'date': "2030-01-01", 'category': "Release", 'title': "Giphy", 'giphyUrl': giphy_url})
+    entry = db.session.query(Entry).filter_by(title="Giphy").one()
+    assert (entry.pending_image_url, entry.image_filename) == (giphy_url, None)
+    schedule_image_ingestion.assert_called_once_with(entry.id, giphy_url)
+
+def test_create_entry_with_invalid_giphy_url(test_client, init_database):
+    """
+    GIVEN a Flask application
+    WHEN an entry is created with a URL that does not point to Giphy
+    THEN check that the entry is created without image and nothing is downloaded
+    """
+    with mock.patch('app.routes.schedule_image_ingestion') as schedule_image_ingestion:
+        test_client.post('/create', data={'date': "2030-01-01", 'category': "Release", 'title': "Invalid",
+                                          'giphyUrl': 'https://invalid-giphy.com/media/test.gif'})
+    entry = db.session.query(Entry).filter_by(title="Invalid").one()
+    assert (entry.pending_image_url, entry.image_filename) == (None, None)
+    schedule_image_ingestion.assert_not_called()
+
 def test_update_entry(test_client, init_database):
     """
     GIVEN a Flask application configured for testing
@@ -178,7 +227,7 @@ def test_timeline_view_with_category_filter(test_client, init_database):
         db.session.add(category)
         db.session.commit()
 
-    entry = Entry(date="2023-06-01", category_id=category.id, title="Release Update", description="Major software release.")
+    entry = Entry(date=date(2023, 6, 1), category_id=category.id, title="Release Update", description="Major software release.")
     db.session.add(entry)
     db.session.commit()
 
@@ -201,7 +250,7 @@ def test_timeline_view_without_category_filter(test_client, init_database):
         db.session.add(category)
         db.session.commit()
     
-    entry = Entry(date="2023-06-01", category_id=category.id, title="Release Update", description="Major software release.")
+    entry = Entry(date=date(2023, 6, 1), category_id=category.id, title="Release Update", description="Major software release.")
     db.session.add(entry)
     db.session.commit()
 
@@ -269,6 +318,44 @@ def test_batch_import(test_client, init_database):
     assert db.session.query(Entry).count() == 2  # Assuming one existing entry
     assert db.session.query(Category).count() == 5 # Including existing categories
 
+def test_batch_import_in_chunks(test_client, init_database):
+    """
+    GIVEN a Flask application with a batch import chunk size of 2
+    WHEN entries and quotes are imported, some quotes twice
+    THEN check that all entries and each quote once are inserted and counted
+    """
+    test_client.application.config['BATCH_IMPORT_CHUNK_SIZE'] = 2
+    db.session.add(Quote(text="Existing", author="Someone"))
+    db.session.commit()
+    data = {
+        'entries': [{'date': f"2022-01-0{day}", 'category': {'name': "Release"}, 'title': f"Release {day}"}
+                    for day in range(1, 6)],
+        'quotes': [{'text': "Existing", 'author': "Someone"}, {'text': "New", 'author': "Someone"},
+                   {'text': "New", 'author': "Someone"}, {'text': "New", 'author': "Another"}]
+    }
+    response = test_client.post('/batch-import', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 201
+    assert json.loads(response.data)['entries'] == 5
+    assert db.session.query(Entry).filter(Entry.title.startswith("Release")).count() == 5
+    assert db.session.query(Quote).count() == 3
+    assert db.session.query(func.sum(DailyEntryCount.count)).scalar() == 6
+
+def test_batch_import_with_unknown_category(test_client, init_database):
+    """
+    GIVEN a Flask application
+    WHEN a batch import contains an entry of an unknown category
+    THEN check that nothing is imported, not even the valid categories and entries
+    """
+    data = {
+        'categories': [{'name': "Webinar", 'symbol': "🌐", 'color_hex': "#008000"}],
+        'entries': [{'date': "2021-07-01", 'category': {'name': "Webinar"}, 'title': "Online Event"},
+                    {'date': "2021-07-02", 'category': {'name': "Unknown"}, 'title': "Lost Event"}]
+    }
+    response = test_client.post('/batch-import', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 400
+    assert db.session.query(Entry).count() == 1
+    assert not db.session.query(Category).filter_by(name="Webinar").first()
+
 def test_update_serial_entries(test_client, init_database):
     """
     GIVEN a Flask application
@@ -278,7 +365,7 @@ def test_update_serial_entries(test_client, init_database):
     # Create a new birthday entry with a different year
     old_year = 2020
     category = db.session.query(Category).filter_by(name="Birthday").first()
-    entry = Entry(date=f"{old_year}-05-20", category=category, title="Another Birthday", description="Test birthday")
+    entry = Entry(date=date(old_year, 5, 20), category=category, title="Another Birthday", description="Test birthday")
     db.session.add(entry)
     db.session.commit()
 
@@ -288,7 +375,7 @@ def test_update_serial_entries(test_client, init_database):
     current_year = datetime.now().year
     birthday_entries = db.session.query(Entry).filter_by(category=category).all()
     for entry in birthday_entries:
-        assert str(current_year) in entry.date
+        assert entry.date.year == current_year
 
 def test_purge_old_entries(test_client, init_database):
     """
@@ -305,13 +392,13 @@ def test_purge_old_entries(test_client, init_database):
 
     # Create entries from different years
     old_entry = Entry(
-        date="2020-01-01",
+        date=date(2020, 1, 1),
         category_id=category_release.id,
         title="Old Release",
         description="This should be purged"
     )
     protected_old_entry = Entry(
-        date="2020-02-01",
+        date=date(2020, 2, 1),
         category_id=category_birthday.id,  # Birthday category is protected
         title="Old Birthday",
         description="This should not be purged"
@@ -350,7 +437,7 @@ def test_entries_sorted_by_date(test_client, init_database):
     
     for i, date_str in enumerate(dates):
         entry = Entry(
-            date=date_str,
+            date=date.fromisoformat(date_str),
             category_id=category.id,
             title=f"Entry {i+1}",
             description=f"Test entry {i+1}"
@@ -371,4 +458,303 @@ def test_entries_sorted_by_date(test_client, init_database):
     assert entry_dates == sorted_dates
 
     # Verify the order is correct
-    assert entry_dates[0] < entry_dates[-1]  # First date should be earlier than last date
\ No newline at end of file
+    assert entry_dates[0] < entry_dates[-1]  # First date should be earlier than last date
+
+def test_api_data_with_entry_window(test_client, init_database):
+    """
+    GIVEN a Flask application with past and upcoming entries
+    WHEN the '/api/data' endpoint is requested with window parameters
+    THEN check that only the requested number of entries around today is returned
+    """
+    category = db.session.query(Category).filter_by(name="Release").first()
+    today = date.today()
+    for offset in (-30, -10, -5, 0, 3, 20, 400):
+        db.session.add(Entry(date=today + timedelta(days=offset), category_id=category.id, title=f"Offset {offset}"))
+    db.session.commit()
+
+    response = test_client.get('/api/data?categories=Release&max-past-entries=2&max-future-entries=2')
+    assert response.status_code == 200
+    entries = json.loads(response.data)['entries']
+    assert [entry['title'] for entry in entries] == ["Offset -10", "Offset -5", "Offset 0", "Offset 3"]
+    assert [entry['index'] for entry in entries] == [-2, -1, 0, 1]
+    assert entries[2]['is_today']
+
+    response = test_client.get('/api/data?categories=Release&days-back=7&days-ahead=30')
+    entries = json.loads(response.data)['entries']
+    assert [entry['title'] for entry in entries] == ["Offset -5", "Offset 0", "Offset 3", "Offset 20"]
+
+    # Negative values are ignored
+    response = test_client.get('/api/data?categories=Release&max-past-entries=-1')
+    assert len(json.loads(response.data)['entries']) == 7
+
+def test_api_entries_keyset_pagination(test_client, init_database):
+    """
+    GIVEN a Flask application with several entries
+    WHEN the '/api/entries' endpoint is paged through with the returned cursors
+    THEN check that every entry in the range is returned exactly once and in order
+    """
+    category = db.session.query(Category).filter_by(name="Release").first()
+    for day in (1, 1, 2, 3, 4, 5):
+        db.session.add(Entry(date=date(2023, 3, day), category_id=category.id, title=f"March {day}"))
+    db.session.add(Entry(date=date(2023, 4, 1), category_id=category.id, title="April"))
+    db.session.commit()
+
+    ids = []
+    url = '/api/entries?from=2023-03-01&to=2023-03-31&categories=Release&limit=4'
+    while url:
+        response = test_client.get(url)
+        assert response.status_code == 200
+        page = json.loads(response.data)
+        assert len(page['entries']) <= 4
+        ids.extend(entry['id'] for entry in page['entries'])
+        url = f"/api/entries?from=2023-03-01&to=2023-03-31&categories=Release&limit=4&cursor={page['next_cursor']}" if page['next_cursor'] else None
+
+    expected = [entry.id for entry in db.session.query(Entry).filter(Entry.category_id == category.id, Entry.date < date(2023, 4, 1)).order_by(Entry.date, Entry.id)]
+    assert ids == expected
+
+def test_api_entries_with_invalid_parameters(test_client, init_database):
+    """
+    GIVEN a Flask application
+    WHEN the '/api/entries' endpoint is requested with an invalid date or cursor
+    THEN check that a 400 error is returned
+    """
+    assert test_client.get('/api/entries?from=01-03-2023').status_code == 400
+    assert test_client.get('/api/entries?cursor=not-a-cursor').status_code == 400
+
+def test_api_data_streamed(test_client, init_database):
+    """
+    GIVEN a Flask application with past and upcoming entries
+    WHEN the '/api/data' endpoint is requested with stream=true
+    THEN check that the streamed JSON matches the regular response
+    """
+    category = db.session.query(Category).filter_by(name="Release").first()
+    for offset in (-3, 0, 5):
+        db.session.add(Entry(date=date.today() + timedelta(days=offset), category_id=category.id, title=f"Offset {offset}"))
+    db.session.commit()
+
+    for query in ('', '&max-past-entries=1'):
+        response = test_client.get(f'/api/data?stream=true{query}')
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert json.loads(response.data) == json.loads(test_client.get(f'/api/data?{query}').data)
+
+def test_export_data(test_client, init_database):
+    """
+    GIVEN a Flask application with entries and quotes
+    WHEN the '/export-data' endpoint is requested
+    THEN check that the zip file contains all entries, categories and quotes
+    """
+    from io import BytesIO
+    from zipfile import ZipFile
+    from app.models import Quote
+    db.session.add(Quote(text="Stay hungry", author="Steve Jobs"))
+    db.session.commit()
+
+    response = test_client.get('/export-data')
+    assert response.status_code == 200
+    with ZipFile(BytesIO(response.data)) as zip_file:
+        data = json.loads(zip_file.read('data.json'))
+    assert [entry['title'] for entry in data['entries']] == ["John's Birthday"]
+    assert len(data['categories']) == db.session.query(Category).count()
+    assert data['quotes'][0]['author'] == "Steve Jobs"
+
+def test_api_data_with_locale(test_client, init_database):
+    """
+    GIVEN a Flask application with an entry
+    WHEN the '/api/data' endpoint is requested with and without a locale
+    THEN check that the dates are formatted in that locale, falling back to the default for unknown ones
+    """
+    def date_formatted(query):
+        return json.loads(test_client.get(f'/api/data{query}').data)['entries'][0]['date_formatted']
+
+    assert date_formatted('') == "20. Mai"
+    assert date_formatted('?locale=fr_FR') == "20. mai"
+    assert date_formatted('?locale=xx_YY') == "20. Mai"
+
+def test_api_data_image_urls(test_client, init_database):
+    """
+    GIVEN a Flask application with an entry that has an image
+    WHEN the '/api/data' endpoint is requested
+    THEN check that the image URLs match the URLs of the upload route
+    """
+    entry = db.session.query(Entry).first()
+    entry.image_filename = f"{entry.id}.gif"
+    db.session.commit()
+
+    data = json.loads(test_client.get('/api/data').data)
+    assert data['entries'][0]['image_url'] == f"/uploads/{entry.id}.gif"
+    assert data['entries'][0]['image_url_external'] == f"http://localhost/uploads/{entry.id}.gif"
+    assert data['entries'][0]['category'] == next(category for category in data['categories'] if category['name'] == "Birthday")
+
+def test_api_data_compact_format_and_fields(test_client, init_database):
+    """
+    GIVEN a Flask application with an entry
+    WHEN the '/api/data' endpoint is requested with format=compact and fields
+    THEN check that entries reference their category by id and only contain the requested fields
+    """
+    data = json.loads(test_client.get('/api/data?format=compact').data)
+    entry = data['entries'][0]
+    assert 'category' not in entry
+    category = next(category for category in data['categories'] if category['id'] == entry['category_id'])
+    assert category['name'] == "Birthday"
+
+    data = json.loads(test_client.get('/api/data?format=compact&fields=id,date,category_id,index').data)
+    assert data['entries'] == [{"id": entry['id'], "date": "2021-05-20", "category_id": category['id'], "index": -1}]
+
+    streamed = json.loads(test_client.get('/api/data?format=compact&fields=id,date,category_id,index&stream=true').data)
+    assert streamed == data
+
+    response = test_client.get('/api/data?fields=id,secret')
+    assert response.status_code == 400
+
+    # Fields of the other format are rejected instead of silently dropped
+    response = test_client.get('/api/data?fields=id,category_id')
+    assert response.status_code == 400
+    assert 'category' in json.loads(response.data)['fields']
+    response = test_client.get('/api/data?format=compact&fields=id,category')
+    assert response.status_code == 400
+
+def test_uploaded_file_versioned_url(test_client, init_database, tmp_path):
+    """
+    GIVEN an entry with an uploaded image
+    WHEN its versioned URL from /api/data is requested, with a Range header, as HEAD and after the image is replaced
+    THEN check that the current revision is immutable, ranges and HEAD work and the URL changes with the file
+    """
+    test_client.application.config['UPLOAD_FOLDER'] = str(tmp_path)
+    (tmp_path / '1.gif').write_bytes(b'GIF89a' + bytes(100))
+    entry = db.session.get(Entry, 1)
+    entry.image_filename = '1.gif'
+    bump_data_version(db)
+    db.session.commit()
+
+    url = json.loads(test_client.get('/api/data').data)['entries'][0]['image_url']
+    assert url.startswith('/uploads/1.gif?v=')
+    response = test_client.get(url)
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+    assert response.data.startswith(b'GIF89a')
+
+    response = test_client.get(url, headers={'Range': 'bytes=0-5'})
+    assert response.status_code == 206
+    assert response.data == b'GIF89a'
+
+    response = test_client.head(url)
+    assert response.status_code == 200
+    assert response.content_length == 106
+
+    response = test_client.get('/uploads/1.gif')
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+
+    os.utime(tmp_path / '1.gif', ns=(0, 0))
+    bump_data_version(db)
+    db.session.commit()
+    assert json.loads(test_client.get('/api/data').data)['entries'][0]['image_url'] != url
+    assert 'immutable' not in test_client.get(url).headers.get('Cache-Control', '')
+
+def test_uploaded_file_sendfile_modes(test_client, tmp_path):
+    """
+    GIVEN an uploaded image and the X-Accel-Redirect and X-Sendfile modes
+    WHEN the image and a missing file are requested
+    THEN check that the file is handed off to the proxy and missing files answer 404
+    """
+    config = test_client.application.config
+    config['UPLOAD_FOLDER'] = str(tmp_path)
+    (tmp_path / '1.png').write_bytes(b'\x89PNG')
+
+    config['UPLOAD_SENDFILE_MODE'] = 'x-accel-redirect'
+    response = test_client.get('/uploads/1.png')
+    assert response.headers['X-Accel-Redirect'] == '/protected-uploads/1.png'
+    assert response.mimetype == 'image/png'
+    assert response.data == b''
+    assert test_client.get('/uploads/2.png').status_code == 404
+
+    config['UPLOAD_SENDFILE_MODE'] = 'x-sendfile'
+    response = test_client.get('/uploads/1.png')
+    assert response.headers['X-Sendfile'] == str(tmp_path / '1.png')
+
+@pytest.fixture
+def giphy_stub(test_client):
+    """Serves Giphy search responses from a local HTTP server and records the received queries."""
+    queries = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)['q'][0]
+            queries.append(query)
+            time.sleep(0.2)  # Keeps requests in flight long enough to overlap
+            body = json.dumps({'data': [{'id': query}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    test_client.application.config['GIPHY_SEARCH_URL'] = f"http://127.0.0.1:{server.server_port}/v1/gifs/search"
+    yield queries
+    server.shutdown()
+    server.server_close()
+
+def test_search_gifs_is_cached(test_client, giphy_stub):
+    """
+    GIVEN a Giphy stub server
+    WHEN the same query is searched twice with different case and spacing, and another query once
+    THEN check that Giphy is only asked once per normalized query
+    """
+    assert json.loads(test_client.get('/search_gifs?q=Cats').data) == [{'id': 'cats'}]
+    assert json.loads(test_client.get('/search_gifs?q=%20cats%20').data) == [{'id': 'cats'}]
+    assert json.loads(test_client.get('/search_gifs?q=dogs').data) == [{'id': 'dogs'}]
+    assert giphy_stub == ['cats', 'dogs']
+
+def test_search_gifs_coalesces_concurrent_queries(test_client, giphy_stub):
+    """
+    GIVEN a Giphy stub server that answers slowly
+    WHEN the same query is searched by several clients at once
+    THEN check that all of them get the result of a single Giphy request
+    """
+    app = test_client.application
+    results = []
+
+    def search():
+        results.append(json.loads(app.test_client().get('/search_gifs?q=birds').data))
+
+    threads = [Thread(target=search) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [[{'id': 'birds'}]] * 5
+    assert giphy_stub == ['birds']
+
+def test_search_gifs_upstream_error(test_client):
+    """
+    GIVEN a Giphy search URL that refuses connections
+    WHEN a query is searched
+    THEN check that a 502 is returned and nothing is cached
+    """
+    test_client.application.config['GIPHY_SEARCH_URL'] = 'http://127.0.0.1:9/v1/gifs/search'
+    with mock.patch('app.helpers.http_session', create_http_session(0)):
+        assert test_client.get('/search_gifs?q=cats').status_code == 502
+    assert len(test_client.application.extensions['giphy_search_cache']._values) == 0
+
+def test_entry_date_migration_normalizes_unpadded_dates(test_client):
+    """
+    GIVEN entries stored as text before the date column migration, one of them with an unpadded date
+    WHEN the migrations are upgraded
+    THEN check that both dates are converted to native dates
+    """
+    downgrade(revision='8d322bf4e7e8')
+    category_id = db.session.execute(text("SELECT id FROM category LIMIT 1")).scalar()
+    db.session.execute(text("INSERT INTO entry (date, category_id, title, cancelled) VALUES "
+                            "('2024-5-3', :category_id, 'Unpadded', 0), (' 2024-05-04 ', :category_id, 'Padded', 0)"),
+                       {'category_id': category_id})
+    db.session.commit()
+
+    upgrade()
+
+    dates = dict(db.session.query(Entry.title, Entry.date).all())
+    assert dates == {'Unpadded': date(2024, 5, 3), 'Padded': date(2024, 5, 4)}
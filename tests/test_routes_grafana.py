@@ -1,6 +1,11 @@
 import json
+from datetime import date, datetime, timezone
+from unittest import mock
 from app.models import Entry, Category
 from app import db
+from app.cache import bump_data_version
+from app.helpers import date_to_millis
+from app.routes_grafana import parse_grafana_time
 
 def test_grafana_test_connection(test_client):
     """
@@ -30,7 +35,7 @@ def test_grafana_query(test_client, init_database):
     category = Category(name="Party", symbol="🎉", color_hex="#FFD700")
     db.session.add(category)
     db.session.flush()  # to obtain the category id
-    db.session.add(Entry(date="2021-05-20", category_id=category.id, title="John's Birthday", description="Birthday party"))
+    db.session.add(Entry(date=date(2021, 5, 20), category_id=category.id, title="John's Birthday", description="Birthday party"))
     db.session.commit()
 
     query_data = {
@@ -76,7 +81,7 @@ def test_grafana_query_with_date_range(test_client, init_database):
     dates = ["2023-01-01", "2023-06-01", "2024-01-01"]
     for date_str in dates:
         entry = Entry(
-            date=date_str,
+            date=date.fromisoformat(date_str),
             category_id=category.id,
             title=f"Test Entry {date_str}",
             description="Test entry"
@@ -100,9 +105,69 @@ def test_grafana_query_with_date_range(test_client, init_database):
     assert response.status_code == 200
     data = json.loads(response.data)
     
-    # Expect entries from within the time range and nearby
+    # Expect only the entries within the time range
     datapoints = data[0]['datapoints']
-    assert len([d for d in datapoints if d[1] is not None]) == 3
+    assert len([d for d in datapoints if d[1] is not None]) == 2
+    assert max(d[1] for d in datapoints) < datetime(2024, 1, 1).timestamp() * 1000
+
+class Python310Datetime(datetime):
+    """datetime whose fromisoformat rejects the Z suffix like Python 3.10 does."""
+
+    @classmethod
+    def fromisoformat(cls, value):
+        if value.endswith('Z'):
+            raise ValueError(f"Invalid isoformat string: {value!r}")
+        return super().fromisoformat(value)
+
+def test_grafana_range_with_z_suffix(test_client, init_database):
+    """
+    Test that Grafana ranges ending in Z are applied even where fromisoformat does not accept the suffix
+    """
+    release = db.session.query(Category).filter_by(name="Release").first()
+    for day in (date(2022, 6, 1), date(2023, 6, 1)):
+        db.session.add(Entry(date=day, category_id=release.id, title=f"Release {day}"))
+    db.session.commit()
+
+    query_data = {
+        "range": {"from": "2023-01-01T00:00:00.000Z", "to": "2023-12-31T23:59:59.999Z"},
+        "targets": [{"target": "Release", "type": "timeserie"}]
+    }
+    with mock.patch('app.routes_grafana.datetime', Python310Datetime):
+        assert parse_grafana_time("2023-01-01T00:00:00.000Z") == datetime(2023, 1, 1, tzinfo=timezone.utc)
+        data = json.loads(test_client.post('/grafana/query', data=json.dumps(query_data), content_type='application/json').data)
+    assert [millis for _, millis in data[0]['datapoints']] == [date_to_millis(date(2023, 6, 1))]
+
+def test_grafana_query_multiple_targets_with_buckets(test_client, init_database):
+    """
+    Test the /grafana/query endpoint with several targets and an interval larger than a day
+    """
+    category = db.session.query(Category).filter_by(name="Release").first()
+    for day in (2, 3, 3, 20):
+        db.session.add(Entry(date=date(2023, 3, day), category_id=category.id, title=f"Release {day}"))
+    db.session.commit()
+
+    query_data = {
+        "range": {"from": "2023-01-01T00:00:00.000Z", "to": "2023-12-31T23:59:59.999Z"},
+        "intervalMs": 7 * 24 * 60 * 60 * 1000,
+        "targets": [
+            {"target": "Release", "type": "timeserie"},
+            {"target": "Birthday", "type": "timeserie"}
+        ]
+    }
+    data = json.loads(test_client.post('/grafana/query', data=json.dumps(query_data), content_type='application/json').data)
+
+    assert [series['target'] for series in data] == ["Release", "Birthday"]
+    # 2 and 3 March fall into the same week aligned to the epoch (starting on Thursday), 20 March into a later one
+    assert [count for count, _ in data[0]['datapoints']] == [3, 1]
+    assert all(millis % query_data['intervalMs'] == 0 for _, millis in data[0]['datapoints'])
+    # The birthday in 2021 is out of range, but the category still gets its series
+    assert data[1]['datapoints'] == []
+
+    query_data['maxDataPoints'] = 1
+    del query_data['intervalMs']
+    data = json.loads(test_client.post('/grafana/query', data=json.dumps(query_data), content_type='application/json').data)
+    assert sum(count for count, _ in data[0]['datapoints']) == 4
+    assert len(data[0]['datapoints']) <= 2
 
 def test_grafana_annotations(test_client, init_database):
     """
@@ -111,7 +176,7 @@ def test_grafana_annotations(test_client, init_database):
     category = Category(name="Launch", symbol="🚀", color_hex="#FF6347")
     db.session.add(category)
     db.session.flush()
-    db.session.add(Entry(date="2021-05-21", category_id=category.id, title="Product Launch", description="Launching a new product"))
+    db.session.add(Entry(date=date(2021, 5, 21), category_id=category.id, title="Product Launch", description="Launching a new product"))
     db.session.commit()
 
     annotation_data = {
@@ -127,6 +192,33 @@ def test_grafana_annotations(test_client, init_database):
     assert data[0]['title'] == "Product Launch"
     assert data[0]['text'] == "Launching a new product"
 
+def test_grafana_annotations_with_range_and_limit(test_client, init_database):
+    """
+    Test the /grafana/annotations endpoint with a time range and a limit across several categories
+    """
+    release = db.session.query(Category).filter_by(name="Release").first()
+    for day in (1, 2, 3):
+        db.session.add(Entry(date=date(2023, 3, day), category_id=release.id, title=f"Release {day}"))
+    db.session.add(Entry(date=date(2024, 3, 1), category_id=release.id, title="Release 2024"))
+    db.session.commit()
+
+    annotation_data = {
+        "range": {"from": "2023-01-01T00:00:00.000Z", "to": "2023-12-31T23:59:59.999Z"},
+        "annotation": {"query": "Release, Birthday"}
+    }
+    data = json.loads(test_client.post('/grafana/annotations', data=json.dumps(annotation_data), content_type='application/json').data)
+    assert [annotation['title'] for annotation in data] == ["Release 1", "Release 2", "Release 3"]
+    assert data[0]['tags'] == ["Release"]
+
+    annotation_data['annotation']['limit'] = 2
+    data = json.loads(test_client.post('/grafana/annotations', data=json.dumps(annotation_data), content_type='application/json').data)
+    assert [annotation['title'] for annotation in data] == ["Release 2", "Release 3"]
+
+    test_client.application.config['GRAFANA_ANNOTATIONS_LIMIT'] = 1
+    test_client.application.extensions['grafana_cache'].clear()  # The data did not change, only the configuration
+    data = json.loads(test_client.post('/grafana/annotations', data=json.dumps(annotation_data), content_type='application/json').data)
+    assert [annotation['title'] for annotation in data] == ["Release 3"]
+
 def test_grafana_annotations_with_empty_query(test_client, init_database):
     """
     Test the /grafana/annotations endpoint with an empty query
@@ -182,6 +274,43 @@ def test_grafana_tag_values_date(test_client, init_database):
     assert isinstance(data, list)
     assert {"text": "2021-05-20"} in data
 
+def test_grafana_tag_values_date_search_and_limit(test_client, init_database):
+    """
+    Test the /grafana/tag-values endpoint with key='date', a search query, a range and a limit
+    """
+    release = db.session.query(Category).filter_by(name="Release").first()
+    for day in (date(2022, 5, 20), date(2023, 1, 5), date(2023, 5, 20), date(2023, 10, 1), date(2023, 10, 1)):
+        db.session.add(Entry(date=day, category_id=release.id, title=f"Release {day}"))
+    db.session.commit()
+
+    def tag_values(**request_data):
+        response = test_client.post('/grafana/tag-values', data=json.dumps({"key": "date", **request_data}),
+                                    content_type='application/json')
+        assert response.status_code == 200
+        return [value['text'] for value in json.loads(response.data)]
+
+    # A year or month selects that span, distinct dates in ascending order
+    assert tag_values(query="2023") == ["2023-01-05", "2023-05-20", "2023-10-01"]
+    assert tag_values(query="2023-10") == ["2023-10-01"]
+    assert tag_values(query="2023-13") == []
+    # Any other text matches anywhere in the date
+    assert tag_values(query="05-20") == ["2021-05-20", "2022-05-20", "2023-05-20"]
+    # The most recent dates are kept by the limit
+    assert tag_values(limit=2) == ["2023-05-20", "2023-10-01"]
+    test_client.application.config['GRAFANA_TAG_VALUES_LIMIT'] = 1
+    assert tag_values(query="05-20", limit=2) == ["2023-05-20"]
+    assert tag_values(query="2022", range={"from": "2022-01-01T00:00:00.000Z", "to": "2022-12-31T23:59:59.999Z"}) \
+        == ["2022-05-20"]
+    assert tag_values(query="2023", range={"from": "2022-01-01T00:00:00.000Z", "to": "2022-12-31T23:59:59.999Z"}) == []
+
+def test_grafana_tag_values_category_search(test_client, init_database):
+    """
+    Test the /grafana/tag-values endpoint with key='category' and a search query
+    """
+    response = test_client.post('/grafana/tag-values', data=json.dumps({"key": "category", "query": "birth"}),
+                                content_type='application/json')
+    assert json.loads(response.data) == [{"text": "Birthday"}]
+
 def test_grafana_tag_values_invalid_key(test_client, init_database):
     """
     Test the /grafana/tag-values endpoint with an invalid key
@@ -195,4 +324,60 @@ def test_grafana_tag_values_invalid_key(test_client, init_database):
     assert response.status_code == 200
     data = json.loads(response.data)
     assert isinstance(data, list)
-    assert len(data) == 0  # Should return empty list for invalid key
\ No newline at end of file
+    assert len(data) == 0  # Should return empty list for invalid key
+
+def test_grafana_query_counts_purged_entries(test_client, init_database):
+    """
+    Test that the /grafana/query endpoint still counts entries removed by purging old entries
+    """
+    category = db.session.query(Category).filter_by(name="Release").first()
+    db.session.add(Entry(date=date(2020, 1, 1), category_id=category.id, title="Old Release"))
+    db.session.commit()
+    test_client.post('/purge-old-entries')
+
+    query_data = {"targets": [{"target": "Release", "type": "timeserie"}]}
+    data = json.loads(test_client.post('/grafana/query', data=json.dumps(query_data), content_type='application/json').data)
+
+    assert not db.session.query(Entry).filter_by(category_id=category.id).count()
+    assert [count for count, _ in data[0]['datapoints']] == [1]
+
+
+def test_grafana_cache_serves_refreshes(test_client, init_database):
+    """
+    Test that refreshes of a dashboard whose range moved by a few seconds are answered from the cache until the data changes
+    """
+    def query(start, end, request_id):
+        query_data = {
+            "requestId": request_id,
+            "range": {"from": start, "to": end},
+            "maxDataPoints": 100,
+            "targets": [{"target": "Birthday", "type": "timeserie"}]
+        }
+        response = test_client.post('/grafana/query', data=json.dumps(query_data), content_type='application/json')
+        assert response.status_code == 200
+        return json.loads(response.data)
+
+    first = query("2021-01-01T10:00:00.000Z", "2021-12-31T10:00:00.000Z", "Q1")
+    second = query("2021-01-01T10:00:05.000Z", "2021-12-31T10:00:05.000Z", "Q2")
+    stats = json.loads(test_client.get('/grafana/cache-stats').data)
+    assert second == first
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+    # A write bumps the data version, the next refresh is computed again
+    category = db.session.query(Category).filter_by(name="Birthday").first()
+    db.session.add(Entry(date=date(2021, 5, 20), category_id=category.id, title="Jane's Birthday"))
+    bump_data_version(db)
+    db.session.commit()
+
+    third = query("2021-01-01T10:00:10.000Z", "2021-12-31T10:00:10.000Z", "Q3")
+    stats = json.loads(test_client.get('/grafana/cache-stats').data)
+    assert sum(count for count, _ in third[0]['datapoints']) == 2
+    assert (stats['hits'], stats['misses']) == (1, 2)
+
+def test_grafana_cache_skips_errors(test_client, init_database):
+    """
+    Test that failed Grafana requests are not kept in the cache
+    """
+    response = test_client.post('/grafana/query', data=json.dumps({"targets": "invalid"}), content_type='application/json')
+    assert response.status_code == 500
+    assert json.loads(test_client.get('/grafana/cache-stats').data)['size'] == 0